@@ -1,13 +1,33 @@
 from os import path, mkdir
 from typing import BinaryIO
-from uuid import uuid4
-from flask import Flask, jsonify, request, abort, send_from_directory, render_template
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as BinasciiError
+from datetime import datetime
+from flask import Flask, jsonify, request, abort, render_template, stream_with_context
 from flask_cors import CORS
-from flask_mail import Mail, Message
-from db import setup_db
-from db.models import Answer, Notification, Permission, Question, User, Role
-from auth import AuthError, generate_token, requires_auth, requires_permission, get_jwt_sub
-from sqlalchemy.exc import IntegrityError
+from flask_mail import Mail
+from db import db, setup_db, get_pool_stats, PRIMARY_PIN_HEADER
+from db.search import search_questions
+from db.suggest import suggest
+from db.export import exportables, export_ndjson
+from cache import conditional
+from cache.responses import setup_response_cache
+from serialization import setup_json
+from compress import setup_compression, send_precompressed, precompress_directory
+from notifications import setup_notifications
+from mailer import setup_outbox
+from media import setup_media, store_stream, remove_files, file_digest, image_pixels, is_content_addressed, variant_name, original_name
+from media.storage import setup_storage
+from db.models import Answer, Notification, Permission, Question, User, Role, StoredFile, Upload, reconcile_counters, get_current_user, get_current_user_id
+from auth import setup_auth, AuthError, generate_token, requires_auth, requires_permission, get_jwt_sub
+from auth.passwords import setup_password_hasher
+from sqlalchemy import tuple_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from werkzeug.exceptions import NotFound, ServiceUnavailable
+import sys
+import gzip
+import mimetypes
+import click
 import imghdr
 import re
 import bleach
@@ -24,32 +44,107 @@ def validate_image(stream: BinaryIO):
     return format if format != "jpeg" else "jpg"
 
 
-def paginate(items: list, page: int = 1, per_page: int = 20):
-    ''' Return a list of paginated items and a dict contains meta data '''
-    start_index = (page - 1) * per_page
-    end_index = start_index + per_page
+def paginate(query, page: int = 1, per_page: int = 20):
+    '''
+    Return a list of paginated items and a dict contains meta data
+
+    pagination happens in the database (LIMIT/OFFSET plus a separate COUNT),
+    so only the requested page is loaded into memory
+    '''
+    pagination = query.paginate(page, per_page, error_out=False)
     meta = {
-        'total': len(items),
-        'current_page': page,
+        'total': pagination.total,
+        'current_page': pagination.page,
         'per_page': per_page
     }
-    return items[start_index:end_index], meta
+    return pagination.items, meta
+
+
+def encode_cursor(item) -> str:
+    ''' Encode the (created_at, id) position of an item as an opaque cursor '''
+    position = '%s|%i' % (item.created_at.isoformat(), item.id)
+    return urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    ''' Return the (created_at, id) position encoded in a cursor '''
+    try:
+        created_at, id = urlsafe_b64decode(
+            cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(id)
+    except (ValueError, UnicodeError, BinasciiError):
+        abort(400, 'cursor is not valid')
+
+
+def paginate_by_cursor(query, model, cursor: str = None, per_page: int = 20):
+    '''
+    Return a list of items that come after cursor and a dict contains meta data
+
+    items are ordered by (created_at, id) descending and filtered by a keyset
+    condition instead of OFFSET, so every page costs the same regardless of depth
+    '''
+    query = query.order_by(None).order_by(
+        model.created_at.desc(), model.id.desc())
+    if cursor:
+        query = query.filter(
+            tuple_(model.created_at, model.id) < decode_cursor(cursor))
+    # fetch one extra item to know if there is a next page
+    items = query.limit(per_page + 1).all()
+    has_next = len(items) > per_page
+    items = items[:per_page]
+    meta = {
+        'per_page': per_page,
+        'next_cursor': encode_cursor(items[-1]) if has_next else None
+    }
+    return items, meta
+
+
+def paginate_request(query, model, per_page: int = 20):
+    '''
+    Paginate query according to current request args
+
+    cursor pagination is used if "cursor" arg exists (an empty cursor means
+    the first page), otherwise fallback to page pagination
+    '''
+    if 'cursor' in request.args:
+        return paginate_by_cursor(query, model, request.args.get('cursor'), per_page)
+    return paginate(query, request.args.get('page', 1, int), per_page)
 
 
 def create_app(config=ProductionConfig):
     ''' create and configure the app '''
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_object(config)
-    CORS(app)
+    # cross origin frontends do not send the SameSite pin cookie, they read the
+    # primary pin header to send it back
+    CORS(app, expose_headers=[PRIMARY_PIN_HEADER])
     mail = Mail(app)
 
+    setup_auth(app)
+    setup_json(app)
+    setup_compression(app)
     setup_db(app)
+    setup_password_hasher(app)
+    notifier = setup_notifications(app)
+    outbox = setup_outbox(app, mail)
+    storage = setup_storage(app)
+    images = setup_media(app, storage, record=StoredFile.mark_variants)
+    # feed pages served to anonymous users, dropped by writes changing them
+    response_cache = setup_response_cache(app)
 
     ### ENDPOINTS ###
 
     @app.route("/")
     def index():
-        return render_template('index.html')
+        # prefer variants built by "flask precompress"
+        return send_precompressed(path.join(app.root_path, app.template_folder), 'index.html') \
+            or render_template('index.html')
+
+    def register_upload(filename: str, size: int):
+        ''' register an upload of the current user within its quota, uploading the same file again is free '''
+        if not Upload.register(get_current_user_id(), filename, size, mimetypes.guess_type(filename)[0],
+                               filename.rsplit('.', 1)[0], app.config['UPLOAD_QUOTA']):
+            abort(422, 'Upload quota exceeded')
 
     @app.post("/api/upload")
     @requires_auth()
@@ -62,17 +157,119 @@ def create_app(config=ProductionConfig):
         file_ext = file.filename.rsplit('.', 1)[1].lower()
         if file_ext not in app.config['ALLOWED_EXTENSIONS']:
             abort(422, 'You cannot upload %s files' % file_ext)
-        if file_ext != validate_image(file.stream):
+        pixels = image_pixels(file.stream)
+        if file_ext != validate_image(file.stream) or pixels is None:
             abort(422, 'Fake data was uploaded')
-
-        # generate unique filename
-        filename = uuid4().hex + "." + file_ext
+        if pixels > app.config['IMAGE_MAX_PIXELS']:
+            abort(422, 'Image dimensions are too large')
 
         # Create upload folder if it doesnot exist
-        if not path.isdir(app.config['UPLOAD_FOLDER']):
-            mkdir(app.config['UPLOAD_FOLDER'])
+        if storage.temp_dir and not path.isdir(storage.temp_dir):
+            mkdir(storage.temp_dir)
+
+        def register(filename: str, size: int):
+            # files over quota are never stored
+            register_upload(filename, size)
+            StoredFile.register(filename, size)
+
+        # files are named after their content, identical files are stored once
+        filename, size, created = store_stream(file.stream, storage, file_ext,
+                                               register=register)
+        if created:
+            # resized variants are generated in background
+            images.process(filename)
+
+        return jsonify({
+            'success': True,
+            'path': filename,
+            'sha256': filename.rsplit('.', 1)[0]
+        })
+
+    @app.get("/api/uploads")
+    @requires_auth()
+    def get_uploads():
+        user_id = get_current_user_id()
+        query = Upload.query.filter_by(user_id=user_id).order_by(
+            Upload.created_at.desc())
+        uploads, meta = paginate_request(query, Upload)
+        meta.update(used=Upload.usage(user_id),
+                    quota=app.config['UPLOAD_QUOTA'])
+        return jsonify({
+            'success': True,
+            'data': [upload.format() for upload in uploads],
+            'meta': meta
+        })
+
+    @app.post("/api/uploads/presign")
+    @requires_auth()
+    def presign_upload():
+        # let clients upload files directly to storage, bytes never transit the app
+        if not storage.supports_presigned_uploads:
+            abort(400, 'Direct uploads are not supported, use /api/upload')
+        data = request.get_json() or {}
+        sha256 = str(data.get('sha256', '')).lower()
+        file_ext = str(data.get('ext', '')).lower()
+        size = data.get('size')
+        if re.fullmatch('[0-9a-f]{64}', sha256) is None:
+            abort(400, 'sha256 hex digest of the file expected in request body')
+        if file_ext not in app.config['ALLOWED_EXTENSIONS']:
+            abort(422, 'You cannot upload %s files' % file_ext)
+        if not isinstance(size, int) or not 0 < size <= app.config['MAX_CONTENT_LENGTH']:
+            abort(422, 'Invalid file size')
+        filename = '%s.%s' % (sha256, file_ext)
+        user_id = get_current_user_id()
+        if not Upload.owns(user_id, filename) \
+                and Upload.usage(user_id) + size > app.config['UPLOAD_QUOTA']:
+            abort(422, 'Upload quota exceeded')
+
+        StoredFile.register(filename, size)
+        if Upload.query.filter_by(name=filename).first() is not None:
+            # identical content has been uploaded and verified already, there is nothing to upload
+            register_upload(filename, storage.size(filename))
+            return jsonify({
+                'success': True,
+                'path': filename,
+                'upload': None
+            })
+        return jsonify({
+            'success': True,
+            'path': filename,
+            'upload': storage.presign_upload(filename, size, sha256)
+        })
+
+    @app.post("/api/uploads/complete")
+    @requires_auth()
+    def complete_upload():
+        if not storage.supports_presigned_uploads:
+            abort(400, 'Direct uploads are not supported, use /api/upload')
+        data = request.get_json() or {}
+        filename = str(data.get('path', ''))
+        if not is_content_addressed(filename) \
+                or original_name(filename, app.config['IMAGE_VARIANTS']) is not None \
+                or filename.rsplit('.', 1)[1] not in app.config['ALLOWED_EXTENSIONS']:
+            abort(400, 'path of a presigned upload expected in request body')
+        size = storage.size(filename)
+        if size is None:
+            abort(404, 'File not found')
+        # the content must be an image matching the name, whether or not the
+        # bucket verified the signed checksum
+        with storage.open(filename) as f:
+            pixels = image_pixels(f)
+            valid = filename.rsplit('.', 1)[1] == validate_image(f) and pixels is not None \
+                and file_digest(f) == filename.rsplit('.', 1)[0]
+        if not valid:
+            storage.delete(filename)
+            abort(422, 'Fake data was uploaded')
+        if pixels > app.config['IMAGE_MAX_PIXELS']:
+            storage.delete(filename)
+            abort(422, 'Image dimensions are too large')
 
-        file.save(path.join(app.config['UPLOAD_FOLDER'], filename))
+        register_upload(filename, size)
+        # restarts the grace period, the file may have been collected since it was presigned
+        StoredFile.register(filename, size)
+        stored = StoredFile.query.get(filename)
+        if stored is None or not stored.variants:
+            images.process(filename)
 
         return jsonify({
             'success': True,
@@ -81,10 +278,35 @@ def create_app(config=ProductionConfig):
 
     @app.get("/uploads/<filename>")
     def uploaded_file(filename):
+        vary = None
+        # content never changes under a content addressed name
+        immutable = is_content_addressed(filename)
+        original = original_name(filename, app.config['IMAGE_VARIANTS'])
+        if original is not None:
+            # generated variants are recorded, storage is not queried
+            stored = StoredFile.query.get(original) if immutable else None
+            # prefer the WebP variant if the client explicitly accepts it
+            webp = filename.rsplit('.', 1)[0] + '.webp'
+            vary = 'Accept'
+            if 'image/webp' in [mimetype for mimetype, quality in request.accept_mimetypes if quality] \
+                    and stored is not None and stored.webp:
+                filename = webp
+            elif stored is None or not stored.variants:
+                # variants are generated in background, serve the original meanwhile
+                filename = original
+                immutable = False
         try:
-            return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
-        except Exception:
+            response = storage.send(filename)
+        except NotFound:
             abort(404, "File not found")
+        if vary:
+            response.vary.add(vary)
+        # redirects to presigned urls expire, only the file itself is cached
+        if immutable and response.status_code in (200, 206, 304):
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['UPLOAD_MAX_AGE']
+            response.cache_control.immutable = True
+        return response
 
     @app.post('/api/login')
     def login():
@@ -97,13 +319,23 @@ def create_app(config=ProductionConfig):
         user = User.query.filter_by(username=username).one_or_none()
         if not user or not user.checkpw(str(password)):
             abort(422, 'username or password is not correct')
-
-        role = Role.query.get(user.role_id)
-        permissions = [permission.name for permission in role.permissions]
+        # rehash the password if the configured cost has changed
+        if user.needs_rehash():
+            try:
+                user.set_pw(str(password))
+                user.update()
+            except (SQLAlchemyError, ServiceUnavailable):
+                # logging in does not depend on it, it is retried on next login
+                app.logger.exception(
+                    'Failed to rehash password of user %i', user.id)
+                db.session.rollback()
+
+        # permissions are cached per role, login costs only the user query
+        permissions = Role.get_permissions(user.role_id)
 
         return jsonify({
             'success': True,
-            'token': generate_token(user.username, permissions),
+            'token': generate_token(user.username, permissions, user.id, user.role_id),
         })
 
     @app.post("/api/register")
@@ -130,7 +362,7 @@ def create_app(config=ProductionConfig):
         if len(password) < 8:
             abort(422, 'Password have to be at least 8 characters in length')
 
-        default_role = Role.query.filter_by(name="general").one_or_none().id
+        default_role = Role.get_id("general")
 
         new_user = User(first_name, last_name, email,
                         username, password, default_role)
@@ -147,13 +379,16 @@ def create_app(config=ProductionConfig):
 
         return jsonify({
             'success': True,
-            'token': generate_token(new_user.username),
+            'token': generate_token(new_user.username, Role.get_permissions(default_role),
+                                    new_user.id, default_role),
         })
 
     @app.get('/api/profile')
     @requires_auth()
     def show_profile():
-        user = User.query.filter_by(username=get_jwt_sub()).first()
+        user = get_current_user()
+        if user is None:
+            abort(404, 'User not found')
         profile = user.format()
         # include confidential data like id, email and phone
         profile.update(id=user.id, email=user.email, phone=user.phone)
@@ -163,10 +398,13 @@ def create_app(config=ProductionConfig):
         })
 
     @app.patch("/api/profile")
+    @response_cache.invalidates
     @requires_auth()
     def patch_profile():
         data = request.get_json() or {}
-        user = User.query.filter_by(username=get_jwt_sub()).first()
+        user = get_current_user()
+        if user is None:
+            abort(404, 'User not found')
         # updating user data
         if 'first_name' in data:
             user.first_name = str(data['first_name']).lower().strip()
@@ -198,9 +436,17 @@ def create_app(config=ProductionConfig):
         if 'bio' in data:
             user.bio = str(data['bio']).lower().strip()
         if 'avatar' in data:
-            if not path.isfile(path.join(app.config['UPLOAD_FOLDER'], data['avatar'])):
+            avatar = str(data['avatar'])
+            # users can only use files they have uploaded
+            if not Upload.owns(user.id, avatar):
+                abort(422, "Avatar is not valid")
+            # content addressed uploads are reference counted, files uploaded
+            # before have no record
+            if is_content_addressed(avatar) and not StoredFile.retain(avatar):
                 abort(422, "Avatar is not valid")
-            user.avatar = data['avatar']
+            if user.avatar:
+                StoredFile.release(user.avatar)
+            user.avatar = avatar
 
         try:
             user.update()
@@ -227,10 +473,12 @@ def create_app(config=ProductionConfig):
     @app.get('/api/notifications')
     @requires_auth()
     def get_notifications():
-        user = User.query.filter_by(username=get_jwt_sub()).first()
-        notifications, meta = paginate(
-            user.notifications.all(), request.args.get('page', 1, int))
-        unread_count = user.notifications.filter_by(is_read=False).count()
+        user_id = get_current_user_id()
+        query = Notification.query.filter_by(user_id=user_id).order_by(
+            Notification.created_at.desc())
+        notifications, meta = paginate_request(query, Notification)
+        unread_count = Notification.query.filter_by(
+            user_id=user_id, is_read=False).count()
 
         return jsonify({
             'success': True,
@@ -242,11 +490,11 @@ def create_app(config=ProductionConfig):
     @app.post('/api/notifications/<int:notification_id>/set-read')
     @requires_auth()
     def set_notification_as_read(notification_id):
-        user = User.query.filter_by(username=get_jwt_sub()).first()
+        user_id = get_current_user_id()
         notification: Notification = Notification.query.get(notification_id)
         if not notification:
             abort(404, "notification not found")
-        if notification.user_id != user.id:
+        if notification.user_id != user_id:
             raise AuthError('You can\'t mutate others notifications', 403)
 
         notification.is_read = True
@@ -255,7 +503,8 @@ def create_app(config=ProductionConfig):
         except:
             abort(422)
 
-        unread_count = user.notifications.filter_by(is_read=False).count()
+        unread_count = Notification.query.filter_by(
+            user_id=user_id, is_read=False).count()
 
         return jsonify({
             'success': True,
@@ -264,36 +513,52 @@ def create_app(config=ProductionConfig):
         })
 
     @app.get('/api/questions')
+    @response_cache.cached
     @requires_auth(optional=True)
     def get_questions():
         search_term = request.args.get('searchTerm', '', str)
+        # order search results by relevance instead of recency
+        by_relevance = request.args.get('orderBy') == 'relevance'
         query = Question.query.order_by(Question.created_at.desc())
 
-        if search_term:
-            all_questions = query.filter(
-                Question.content.ilike(f'%{search_term}%')).all()
-        else:
-            all_questions = query.all()
+        if search_term.strip():
+            if by_relevance and 'cursor' in request.args:
+                abort(400, 'cursor pagination cannot be ordered by relevance')
+            query = search_questions(query, search_term, by_relevance)
 
-        questions, meta = paginate(
-            all_questions, request.args.get('page', 1, int))
+        questions, meta = paginate_request(query, Question)
         return jsonify({
             'success': True,
-            'data': [question.format() for question in questions],
+            'data': Question.format_many(questions),
             'meta': meta,
             'search_term': search_term
         })
 
+    @app.get('/api/suggest')
+    def get_suggestions():
+        term = request.args.get('q', '', str).strip()
+        if not term:
+            abort(400, 'q expected in query string')
+        limit = min(max(request.args.get('limit', 5, int), 1), 10)
+        questions, users = suggest(term, limit)
+        return jsonify({
+            'success': True,
+            'data': {
+                'questions': questions,
+                'users': users
+            }
+        })
+
     @app.get('/api/questions/<int:question_id>')
     @requires_auth(optional=True)
     def show_question(question_id):
         question = Question.query.get(question_id)
         if question is None:
             abort(404)
-        return jsonify({
+        return conditional(lambda: jsonify({
             'success': True,
             'data': question.format()
-        })
+        }), question.updated_at, question.user.updated_at)
 
     @app.get('/api/questions/<int:question_id>/answers')
     @requires_auth(optional=True)
@@ -302,23 +567,29 @@ def create_app(config=ProductionConfig):
         if question is None:
             abort(404, 'Question not found')
 
-        answers, meta = paginate(
-            question.answers, request.args.get('page', 1, int), 4)
-        return jsonify({
-            'success': True,
-            'data': [answer.format() for answer in answers],
-            'meta': meta
-        })
+        def build():
+            query = Answer.query.filter_by(question_id=question.id).order_by(
+                Answer.created_at.desc())
+            answers, meta = paginate_request(query, Answer, 4)
+            return jsonify({
+                'success': True,
+                'data': Answer.format_many(answers),
+                'meta': meta
+            })
+
+        # answers count of the question changes when answers are added or deleted
+        return conditional(build, question.updated_at, *question.answers_updated_at())
 
     @app.post('/api/questions')
+    @response_cache.invalidates
     @requires_auth()
     def post_question():
         data = request.get_json() or []
         if 'content' not in data:
             abort(400, 'content expected in request body')
 
-        user = User.query.filter_by(username=get_jwt_sub()).first()
-        new_question = Question(user.id, data['content'])
+        user_id = get_current_user_id()
+        new_question = Question(user_id, data['content'])
         try:
             new_question.insert()
         except Exception:
@@ -330,16 +601,17 @@ def create_app(config=ProductionConfig):
         })
 
     @app.patch('/api/questions/<int:question_id>')
+    @response_cache.invalidates
     @requires_auth()
     def patch_question(question_id):
         data = request.get_json() or []
         question = Question.query.get(question_id)
         if question is None:
             abort(404, 'question not found')
-        user = User.query.filter_by(username=get_jwt_sub()).first()
+        user_id = get_current_user_id()
 
         # check if current user owns the target question
-        if user.id != question.user_id:
+        if user_id != question.user_id:
             raise AuthError('You can\'t update others questions', 403)
 
         # update accepted answer
@@ -363,6 +635,7 @@ def create_app(config=ProductionConfig):
         })
 
     @app.post('/api/questions/<int:question_id>/vote')
+    @response_cache.invalidates
     @requires_auth()
     def vote_question(question_id):
         vote = request.get_json().get('vote')
@@ -373,18 +646,18 @@ def create_app(config=ProductionConfig):
         if question is None:
             abort(404, 'question not found')
 
-        user = User.query.filter_by(username=get_jwt_sub()).first()
+        user_id = get_current_user_id()
         try:
             if vote == 0:
-                question.unvote(user)
+                upvotes, downvotes = question.unvote(user_id)
             else:
-                question.vote(user, True if vote == 1 else False)
+                upvotes, downvotes = question.vote(
+                    user_id, True if vote == 1 else False)
                 # notification
                 content = 'Your question has new %s "%s"' % (
                     'upvote' if vote == 1 else 'downvote', question.content)
                 url = '/questions/%i' % question_id
-                notification = Notification(question.user_id, content, url)
-                notification.insert()
+                notifier.notify(question.user_id, content, url)
         except Exception:
             abort(422)
 
@@ -392,21 +665,22 @@ def create_app(config=ProductionConfig):
             'success': True,
             'data': {
                 'id': question.id,
-                'upvotes': question.votes.filter_by(vote=True).count(),
-                'downvotes': question.votes.filter_by(vote=False).count(),
-                'viewer_vote': question.get_user_vote(user)
+                'upvotes': upvotes,
+                'downvotes': downvotes,
+                'viewer_vote': None if vote == 0 else vote == 1
             }
         })
 
     @app.delete('/api/questions/<int:question_id>')
+    @response_cache.invalidates
     @requires_auth()
     def delete_question(question_id):
         question = Question.query.get(question_id)
         if question is None:
             abort(404)
-        user = User.query.filter_by(username=get_jwt_sub()).first()
+        user_id = get_current_user_id()
         # check if the current user owns the target question
-        if user.id != question.user_id:
+        if user_id != question.user_id:
             if not requires_permission('delete:questions'):
                 raise AuthError('You don\'t have '
                                 'the authority to delete other users questions', 403)
@@ -425,12 +699,13 @@ def create_app(config=ProductionConfig):
         answer = Answer.query.get(answer_id)
         if answer is None:
             abort(404)
-        return jsonify({
+        return conditional(lambda: jsonify({
             'success': True,
             'data': answer.format()
-        })
+        }), answer.updated_at, answer.user.updated_at)
 
     @app.post('/api/answers')
+    @response_cache.invalidates
     @requires_auth()
     def post_answer():
         data = request.get_json() or []
@@ -443,17 +718,16 @@ def create_app(config=ProductionConfig):
             abort(404, 'question not found')
         # sanitize input
         content = bleach.clean(data['content'])
-        user = User.query.filter_by(username=get_jwt_sub()).first()
-        new_answer = Answer(user.id, question.id, content)
-        # notification
-        content = 'Your question has new answer "%s"' % question.content
-        url = '/questions/%i' % data['question_id']
-        notification = Notification(question.user_id, content, url)
+        user_id = get_current_user_id()
+        new_answer = Answer(user_id, question.id, content)
         try:
             new_answer.insert()
-            notification.insert()
         except Exception:
             abort(422)
+        # notification
+        content = 'Your question has new answer "%s"' % question.content
+        url = '/questions/%i' % data['question_id']
+        notifier.notify(question.user_id, content, url)
         return jsonify({
             'success': True,
             'data': new_answer.format()
@@ -466,9 +740,9 @@ def create_app(config=ProductionConfig):
         answer = Answer.query.get(answer_id)
         if not answer:
             abort("404", "answer not found!")
-        user = User.query.filter_by(username=get_jwt_sub()).first()
+        user_id = get_current_user_id()
         # check if current user owns the target answer
-        if user.id != answer.user_id:
+        if user_id != answer.user_id:
             raise AuthError('You can\'t update others answers', 403)
 
         # update content
@@ -497,19 +771,19 @@ def create_app(config=ProductionConfig):
         if answer is None:
             abort(404, 'answer not found')
 
-        user = User.query.filter_by(username=get_jwt_sub()).first()
+        user_id = get_current_user_id()
         try:
             if vote == 0:
-                answer.unvote(user)
+                upvotes, downvotes = answer.unvote(user_id)
             else:
-                answer.vote(user, True if vote == 1 else False)
+                upvotes, downvotes = answer.vote(
+                    user_id, True if vote == 1 else False)
                 # notification
                 content = 'Your answer has new %s "%s"' % (
                     'upvote' if vote == 1 else 'downvote', answer.content)
                 url = '/questions/%i?answer_id=%i' % (
                     answer.question_id, answer_id)
-                notification = Notification(answer.user_id, content, url)
-                notification.insert()
+                notifier.notify(answer.user_id, content, url)
         except Exception:
             abort(422)
 
@@ -517,21 +791,22 @@ def create_app(config=ProductionConfig):
             'success': True,
             'data': {
                 'id': answer.id,
-                'upvotes': answer.votes.filter_by(vote=True).count(),
-                'downvotes': answer.votes.filter_by(vote=False).count(),
-                'viewer_vote': answer.get_user_vote(user)
+                'upvotes': upvotes,
+                'downvotes': downvotes,
+                'viewer_vote': None if vote == 0 else vote == 1
             }
         })
 
     @app.delete('/api/answers/<int:answer_id>')
+    @response_cache.invalidates
     @requires_auth()
     def delete_answer(answer_id):
         answer = Answer.query.get(answer_id)
         if answer is None:
             abort(404)
-        user = User.query.filter_by(username=get_jwt_sub()).first()
+        user_id = get_current_user_id()
         # check if the current user owns the target answer
-        if user.id != answer.user_id:
+        if user_id != answer.user_id:
             if not requires_permission('delete:answers'):
                 raise AuthError('You don\'t have '
                                 'the authority to delete other users answers', 403)
@@ -550,10 +825,10 @@ def create_app(config=ProductionConfig):
         if not user:
             abort(404, 'User not found')
 
-        return jsonify({
+        return conditional(lambda: jsonify({
             'success': True,
             'data': user.format()
-        })
+        }), user.updated_at)
 
     @app.get('/api/users/<username>/questions')
     @requires_auth(optional=True)
@@ -562,12 +837,13 @@ def create_app(config=ProductionConfig):
         if not user:
             abort(404, 'User not found')
 
-        questions, meta = paginate(
-            user.questions, request.args.get('page', 1, int))
+        query = Question.query.filter_by(user_id=user.id).order_by(
+            Question.created_at.desc())
+        questions, meta = paginate_request(query, Question)
 
         return jsonify({
             'success': True,
-            'data': [questions.format() for questions in questions],
+            'data': Question.format_many(questions),
             'meta': meta
         })
 
@@ -582,17 +858,15 @@ def create_app(config=ProductionConfig):
         if question is None:
             abort(404, 'question not found!')
 
-        msg = Message('Reporting question')
-        # email admin (my self)
-        msg.add_recipient(app.config.get('MAIL_DEFAULT_SENDER'))
-        msg.body = 'user "%s" has reported question "%i"' % (
-            username, question_id)
-        msg.html = 'user <code>"%s"</code> has reported question <code>"%i"</code>' % (
+        # email admin (my self), reports are sent by the outbox in background
+        body = 'user "%s" has reported question "%i"' % (username, question_id)
+        html = 'user <code>"%s"</code> has reported question <code>"%i"</code>' % (
             username, question_id)
         try:
-            mail.send(msg)
-        except Exception as e:
-            abort(422, e)
+            outbox.queue(app.config.get('MAIL_DEFAULT_SENDER'),
+                         'Reporting question', body, html, digest=True)
+        except Exception:
+            abort(422)
         return jsonify({
             'success': True
         })
@@ -608,18 +882,45 @@ def create_app(config=ProductionConfig):
         if answer is None:
             abort(404, 'answer not found!')
 
-        msg = Message('Reporting answer')
-        # email admin (my self)
-        msg.add_recipient(app.config.get('MAIL_DEFAULT_SENDER'))
-        msg.body = 'user "%s" has reported answer "%i"' % (
+        # email admin (my self), reports are sent by the outbox in background
+        body = 'user "%s" has reported answer "%i"' % (username, answer_id)
+        html = 'user <code>"%s"</code> has reported answer <code>"%i"</code>' % (
             username, answer_id)
-        msg.html = 'user <code>"%s"</code> has reported answer <code>"%i"</code>' % (
-            username, answer_id)
-        mail.send(msg)
+        try:
+            outbox.queue(app.config.get('MAIL_DEFAULT_SENDER'),
+                         'Reporting answer', body, html, digest=True)
+        except Exception:
+            abort(422)
         return jsonify({
             'success': True
         })
 
+    @app.get('/api/metrics')
+    @requires_auth()
+    def show_metrics():
+        if not requires_permission('read:metrics'):
+            raise AuthError('You don\'t have the authority to read metrics', 403)
+        return jsonify({
+            'success': True,
+            'data': {
+                'db': get_pool_stats(),
+                'response_cache': response_cache.stats()
+            }
+        })
+
+    @app.get('/api/export/<kind>')
+    @requires_auth()
+    def export_data(kind):
+        if not requires_permission('export:data'):
+            raise AuthError('You don\'t have the authority to export data', 403)
+        if kind not in exportables:
+            abort(404, 'Unknown export')
+        # rows are streamed as they are read, compressed if the client accepts it
+        response = app.response_class(stream_with_context(export_ndjson(kind)),
+                                      mimetype='application/x-ndjson')
+        response.headers['Content-Disposition'] = 'attachment; filename=%s.ndjson' % kind
+        return response
+
     ### HANDLING ERRORS ###
 
     @app.errorhandler(404)
@@ -662,6 +963,14 @@ def create_app(config=ProductionConfig):
             'error': 413
         }), 413
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            'success': False,
+            'message': error.description,
+            'error': 503
+        }), 503
+
     @app.errorhandler(AuthError)
     def handle_auth_error(error):
         return jsonify({
@@ -678,12 +987,84 @@ def create_app(config=ProductionConfig):
         delete_users = Permission('delete:users')
         delete_answers = Permission('delete:answers')
         delete_questions = Permission('delete:questions')
+        read_metrics = Permission('read:metrics')
+        export_data = Permission('export:data')
         # roles
         general = Role('general')
         superamdin = Role('superadmin')
         superamdin.permissions.extend(
-            [delete_users, delete_answers, delete_questions])
+            [delete_users, delete_answers, delete_questions, read_metrics, export_data])
         general.insert()
         superamdin.insert()
 
+    @app.cli.command('send_mail')
+    def send_mail():
+        # send due messages of the mail outbox
+        sent = outbox.send_pending()
+        print('%i queued messages have been sent' % sent)
+
+    @app.cli.command('purge_outbox')
+    def purge_outbox():
+        # delete old sent and failed messages of the mail outbox
+        deleted = outbox.purge()
+        print('%i outbox messages have been deleted' % deleted)
+
+    @app.cli.command('reconcile_counters')
+    def reconcile_counters_command():
+        # fix any drift in votes, answers and questions counters
+        drifted = reconcile_counters()
+        print('%i rows had drifted counters and have been fixed' % drifted)
+
+    @app.cli.command('export')
+    @click.argument('kinds', nargs=-1, type=click.Choice(list(exportables)))
+    @click.option('--output', '-o', default='-', help='Output file, stdout by default')
+    @click.option('--gzip', 'compress', is_flag=True, help='Compress output with gzip')
+    def export_command(kinds, output, compress):
+        # write tables as newline delimited JSON, all exportable tables by default
+        file = sys.stdout.buffer if output == '-' else open(output, 'wb')
+        # closing the gzip stream does not close the underlying file
+        stream = gzip.GzipFile(fileobj=file, mode='wb') if compress else file
+        try:
+            for kind in kinds or exportables:
+                for chunk in export_ndjson(kind):
+                    stream.write(chunk.encode())
+        finally:
+            if stream is not file:
+                stream.close()
+            if file is not sys.stdout.buffer:
+                file.close()
+
+    @app.cli.command('generate_variants')
+    def generate_variants():
+        # generate (or record existing) resized variants of uploaded images
+        count = 0
+        for (filename,) in StoredFile.query.filter_by(variants=False).with_entities(StoredFile.name):
+            if filename.rsplit('.', 1)[-1] not in app.config['ALLOWED_EXTENSIONS'] \
+                    or not storage.exists(filename):
+                continue
+            if storage.exists(variant_name(filename, 'small')):
+                StoredFile.mark_variants(filename, storage.exists(
+                    variant_name(filename, 'small', 'webp')))
+            else:
+                images.run(filename)
+            count += 1
+        print('variants of %i images have been generated' % count)
+
+    @app.cli.command('gc_uploads')
+    def gc_uploads():
+        # remove uploads which have not been referenced within the grace period
+        names = StoredFile.collect(app.config['UPLOAD_GC_GRACE'], lambda name: remove_files(
+            storage, name, app.config['IMAGE_VARIANTS']))
+        print('%i unreferenced uploads have been removed' % len(names))
+
+    @app.cli.command('precompress')
+    def precompress():
+        # build gzip and brotli variants of templates and uploads
+        written = 0
+        for directory in (path.join(app.root_path, app.template_folder), app.config['UPLOAD_FOLDER']):
+            if path.isdir(directory):
+                written += precompress_directory(
+                    directory, app.config['COMPRESS_MIMETYPES'])
+        print('%i precompressed files have been written' % written)
+
     return app
@@ -1,8 +1,17 @@
 from functools import wraps
+from collections import OrderedDict
+from threading import Lock
+from time import time
 from flask import request, _request_ctx_stack, current_app
 from jose import jwt
 from datetime import datetime, timedelta
 
+try:
+    # optional faster JWT backend, enabled by JWT_BACKEND = 'pyjwt'
+    import jwt as pyjwt
+except ImportError:
+    pyjwt = None
+
 
 class AuthError(Exception):
     ''' Base class for all auth excpetions '''
@@ -13,6 +22,57 @@ class AuthError(Exception):
         self.code = code
 
 
+class TokenCache:
+    ''' Bounded LRU cache of verified tokens payloads, expired payloads are never returned '''
+
+    def __init__(self, size: int):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, token: str):
+        with self.lock:
+            payload = self.items.get(token)
+            if payload is None:
+                return None
+            if payload.get('exp', float('inf')) <= time():
+                del self.items[token]
+                return None
+            self.items.move_to_end(token)
+            return payload
+
+    def set(self, token: str, payload: dict):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.items[token] = payload
+            self.items.move_to_end(token)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+def get_token_cache() -> TokenCache:
+    ''' Return the verified tokens cache of the current app '''
+    if 'jwt_cache' not in current_app.extensions:
+        current_app.extensions['jwt_cache'] = TokenCache(
+            current_app.config['JWT_CACHE_SIZE'])
+    return current_app.extensions['jwt_cache']
+
+
+def decode_token(token: str) -> dict:
+    ''' Verify token signature and claims using the configured JWT backend '''
+    secret_key = current_app.config['SECRET_KEY']
+    if current_app.config['JWT_BACKEND'] == 'pyjwt':
+        try:
+            return pyjwt.decode(token, secret_key, algorithms=['HS256'])
+        except pyjwt.InvalidTokenError:
+            raise AuthError('Token is invalid', 401)
+    try:
+        return jwt.decode(token, secret_key, 'HS256')
+    except (jwt.JWTClaimsError, jwt.JWTError):
+        raise AuthError('Token is invalid', 401)
+
+
 def get_token_auth_header() -> str:
     ''' get token from current request Authorization header '''
 
@@ -41,11 +101,12 @@ def verify_jwt_in_request():
     '''
 
     token = get_token_auth_header()
-    secret_key = current_app.config['SECRET_KEY']
-    try:
-        payload = jwt.decode(token, secret_key, 'HS256')
-    except (jwt.JWTClaimsError, jwt.JWTError):
-        raise AuthError('Token is invalid', 401)
+    # verified payloads are cached, so a token is verified once until it expires
+    cache = get_token_cache()
+    payload = cache.get(token)
+    if payload is None:
+        payload = decode_token(token)
+        cache.set(token, payload)
 
     _request_ctx_stack.top.current_user = payload
 
@@ -55,6 +116,9 @@ def requires_auth(optional: bool = False):
     def wrapper(f):
         @wraps(f)
         def decorator(*args, **kwargs):
+            # fast path for anonymous requests to optional endpoints
+            if optional and 'Authorization' not in request.headers:
+                return f(*args, **kwargs)
             try:
                 verify_jwt_in_request()
             except AuthError as e:
@@ -72,14 +136,24 @@ def requires_permission(required_permission: str) -> bool:
     return required_permission in permissions
 
 
-def generate_token(sub: str, permissions: list = []) -> str:
+def generate_token(sub: str, permissions: list = [], user_id: int = None, role_id: int = None) -> str:
     ''' Generate JWT token '''
     payload = {
         'sub': sub,
         'exp': datetime.now() + timedelta(days=30),
         'permissions': permissions
     }
-    token = jwt.encode(payload, current_app.config['SECRET_KEY'], 'HS256')
+    if user_id is not None:
+        # carrying user id allows skipping the user lookup or loading it by primary key
+        payload['uid'] = user_id
+    if role_id is not None:
+        payload['role'] = role_id
+    if current_app.config['JWT_BACKEND'] == 'pyjwt':
+        token = pyjwt.encode(
+            payload, current_app.config['SECRET_KEY'], 'HS256')
+    else:
+        token = jwt.encode(
+            payload, current_app.config['SECRET_KEY'], 'HS256')
     return str(token)
 
 
@@ -92,3 +166,27 @@ def get_jwt_sub() -> str:
         return None
     else:
         return _request_ctx_stack.top.current_user['sub']
+
+
+def get_jwt_uid() -> int:
+    '''
+    In a protected endpoint, this will return the user id carried by the JWT that is accessing the endpoint.
+    If no JWT is present or the JWT does not carry a user id, ``None`` is returned.
+    '''
+    if not hasattr(_request_ctx_stack.top, 'current_user'):
+        return None
+    else:
+        return _request_ctx_stack.top.current_user.get('uid')
+
+
+def setup_auth(app):
+    '''
+    setup_auth(app)
+
+    check the JWT_BACKEND once, so a missing backend fails at startup
+    instead of failing every authenticated request
+    '''
+    if app.config['JWT_BACKEND'] not in ('jose', 'pyjwt'):
+        raise RuntimeError('JWT_BACKEND must be "jose" or "pyjwt"')
+    if app.config['JWT_BACKEND'] == 'pyjwt' and pyjwt is None:
+        raise RuntimeError('JWT_BACKEND is "pyjwt" but PyJWT is not installed')
@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+import bcrypt
+from flask import abort, current_app
+
+
+class PasswordHasher:
+    '''
+    Hash and verify passwords with bcrypt on a bounded thread pool
+
+    bcrypt releases the GIL so hashing does not stall other request threads,
+    and at most workers + queue_depth operations are admitted at a time:
+    extra login/register requests fail fast with 503 instead of piling up
+    '''
+
+    def __init__(self, rounds: int = 12, workers: int = 2, queue_depth: int = 8):
+        self.rounds = rounds
+        self.executor = ThreadPoolExecutor(
+            workers, thread_name_prefix='bcrypt')
+        self.slots = BoundedSemaphore(workers + queue_depth)
+
+    def run(self, fn, *args):
+        ''' run fn on the pool and wait for its result '''
+        slots = self.slots
+        if not slots.acquire(blocking=False):
+            abort(503, 'Too many authentication requests, try again later')
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            slots.release()
+
+    def hash(self, password: str) -> bytes:
+        ''' hash password with the configured cost factor '''
+        return self.run(bcrypt.hashpw, bytes(password, 'utf-8'), bcrypt.gensalt(self.rounds))
+
+    def check(self, password: str, hashed: bytes) -> bool:
+        ''' check if password matches hashed '''
+        return self.run(bcrypt.checkpw, bytes(password, 'utf-8'), hashed)
+
+    def needs_rehash(self, hashed: bytes) -> bool:
+        ''' check if hashed was produced with a cost factor other than the configured one '''
+        # bcrypt hashes look like $2b$<cost>$<salt and hash>
+        return int(hashed.split(b'$')[2]) != self.rounds
+
+
+def get_password_hasher() -> PasswordHasher:
+    ''' Return the password hasher of the current app '''
+    return current_app.extensions['password_hasher']
+
+
+def setup_password_hasher(app):
+    '''
+    setup_password_hasher(app)
+
+    create the password hasher of a flask application from its config
+    '''
+    hasher = PasswordHasher(app.config['BCRYPT_LOG_ROUNDS'],
+                            app.config['PASSWORD_HASH_WORKERS'],
+                            app.config['PASSWORD_HASH_QUEUE_DEPTH'])
+    app.extensions['password_hasher'] = hasher
+    return hasher
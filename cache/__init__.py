@@ -0,0 +1,64 @@
+import hashlib
+from datetime import datetime, timezone
+from flask import request, current_app, make_response
+from auth import get_jwt_sub
+
+
+def make_etag(*stamps) -> str:
+    '''
+    Build an etag from the version stamps of the rows a response is made of
+
+    the request path, query string and viewer are part of the tag, as
+    responses differ by page and by viewer (viewer_vote)
+    '''
+    key = repr((request.full_path, get_jwt_sub(), stamps))
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def set_cache_headers(response, etag: str, last_modified: datetime):
+    '''
+    Set validators and caching policy of a response
+
+    anonymous responses can be cached by shared caches (CDN), responses
+    of authenticated requests are private to their viewer
+    '''
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    if 'Authorization' in request.headers:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['HTTP_CACHE_MAX_AGE']
+        response.cache_control.must_revalidate = True
+    response.vary.add('Authorization')
+    return response
+
+
+def is_fresh(etag: str, last_modified: datetime) -> bool:
+    ''' Check if the client copy of the response is still valid '''
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        # http dates have a resolution of one second
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def conditional(build, *stamps: datetime):
+    '''
+    Respond to a GET request with a weak etag and a last modified date
+    derived from the version stamps of the rows the response is made of
+
+    "304 Not Modified" is returned before calling build if the client copy
+    is still valid, otherwise build is called to make the response
+    '''
+    stamps = [stamp.replace(tzinfo=timezone.utc)
+              for stamp in stamps if stamp is not None]
+    etag = make_etag(*[stamp.isoformat() for stamp in stamps])
+    last_modified = max(stamps)
+    if is_fresh(etag, last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(build())
+    return set_cache_headers(response, etag, last_modified)
@@ -0,0 +1,212 @@
+from functools import wraps
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from flask import request, current_app
+from werkzeug.utils import import_string
+
+try:
+    # optional shared backend, enabled by RESPONSE_CACHE_BACKEND = 'redis'
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryCache:
+    '''
+    Bounded in-process LRU cache whose entries expire after ttl seconds
+
+    every worker process has its own cache, invalidations do not reach
+    the other workers whose entries only expire
+    '''
+
+    def __init__(self, app):
+        self.size = app.config['RESPONSE_CACHE_SIZE']
+        self.ttl = app.config['RESPONSE_CACHE_TTL']
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def key(self, key: str) -> str:
+        return key
+
+    def get(self, key: str):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires <= monotonic():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.items[key] = (monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class RedisCache:
+    '''
+    Redis cache shared by all processes, entries expire after ttl seconds
+
+    clear bumps a shared generation which is part of every key, so stale
+    entries are never read again and left to expire. keys are resolved to
+    the current generation by key() before reading or computing an entry
+    '''
+
+    def __init__(self, app):
+        if redis is None:
+            raise RuntimeError(
+                'RESPONSE_CACHE_BACKEND is "redis" but redis is not installed')
+        self.client = redis.Redis.from_url(app.config['RESPONSE_CACHE_REDIS_URL'])
+        self.ttl = app.config['RESPONSE_CACHE_TTL']
+        self.prefix = 'sal:responses:'
+
+    def key(self, key: str) -> str:
+        generation = int(self.client.get(self.prefix + 'generation') or 0)
+        return '%s%i:%s' % (self.prefix, generation, key)
+
+    def get(self, key: str):
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes):
+        self.client.set(key, value, ex=self.ttl)
+
+    def clear(self):
+        self.client.incr(self.prefix + 'generation')
+
+
+backends = {
+    'memory': MemoryCache,
+    'redis': RedisCache
+}
+
+
+class ResponseCache:
+    '''
+    Cache of anonymous JSON responses keyed on route and query args
+
+    on a miss only one request per key computes the response while
+    concurrent requests for the same key wait for it (single flight)
+    '''
+
+    def __init__(self, app, backend):
+        self.app = app
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        # bumped by invalidate, responses computed meanwhile are not stored
+        self.generation = 0
+        self.flights = {}
+        self.lock = Lock()
+
+    def fetch(self, key: str, compute):
+        '''
+        Return the cached body of key, compute and store it on a miss
+
+        compute returns the body to cache or None if it must not be cached.
+        the backend key is resolved before computing, so a body computed while
+        another process invalidates the cache is stored under the previous
+        generation which is never read again
+        '''
+        body = self.backend.get(self.backend.key(key))
+        if body is not None:
+            self.count(hit=True)
+            return body, True
+        with self.lock:
+            flight = self.flights.setdefault(key, Lock())
+        try:
+            with flight:
+                # a concurrent request may have computed it while we waited
+                generation = self.generation
+                stored_key = self.backend.key(key)
+                body = self.backend.get(stored_key)
+                if body is not None:
+                    self.count(hit=True)
+                    return body, True
+                self.count(hit=False)
+                body = compute()
+                if body is not None and generation == self.generation:
+                    self.backend.set(stored_key, body)
+                return body, False
+        finally:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+
+    def count(self, hit: bool):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def invalidate(self):
+        ''' Drop all cached responses '''
+        with self.lock:
+            self.generation += 1
+        self.backend.clear()
+
+    def cached(self, f):
+        ''' Serve anonymous GET requests of the decorated endpoint from the cache '''
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or 'Authorization' in request.headers:
+                return f(*args, **kwargs)
+
+            response = None
+
+            def compute():
+                nonlocal response
+                response = current_app.make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return None
+                return response.get_data()
+
+            body, hit = self.fetch(request.full_path, compute)
+            if response is None:
+                response = current_app.response_class(
+                    body, mimetype='application/json')
+            response.headers['X-Cache'] = 'HIT' if hit else 'MISS'
+            return response
+        return wrapper
+
+    def invalidates(self, f):
+        ''' Invalidate the cache after each successful request to the decorated endpoint '''
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            response = current_app.make_response(f(*args, **kwargs))
+            if response.status_code < 400:
+                self.invalidate()
+            return response
+        return wrapper
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def setup_response_cache(app):
+    '''
+    setup_response_cache(app)
+
+    create the response cache stored by RESPONSE_CACHE_BACKEND, which is either
+    a name of a built-in backend or an import path of a class implementing
+    key(key), get(key), set(key, value) and clear(). key returns the key
+    under which entries are stored, get and set are called with it
+    '''
+    backend = app.config['RESPONSE_CACHE_BACKEND']
+    backend_class = backends.get(backend) or import_string(backend)
+    response_cache = ResponseCache(app, backend_class(app))
+    app.extensions['response_cache'] = response_cache
+    return response_cache
@@ -0,0 +1,146 @@
+import gzip
+import zlib
+import mimetypes
+from os import path, listdir
+from flask import request, current_app, send_from_directory
+from werkzeug.security import safe_join
+
+try:
+    # optional brotli encoding, gzip is used if it is not installed
+    import brotli
+except ImportError:
+    brotli = None
+
+# extensions of precompressed variants by content encoding
+extensions = {'br': '.br', 'gzip': '.gz'}
+
+
+def negotiate_encoding() -> str:
+    ''' Return the best content encoding accepted by the client, None if there is none '''
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    ''' Compress a whole body at once '''
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, level, mtime=0)
+
+
+def compress_stream(chunks, encoding: str, level: int, flush_size: int):
+    '''
+    Compress a streamed body chunk by chunk
+
+    compressed data is flushed every flush_size bytes of input so clients
+    receive data as it is produced without flushing tiny chunks
+    '''
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        step, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        step, finish = compressor.compress, compressor.flush
+
+        def flush():
+            return compressor.flush(zlib.Z_SYNC_FLUSH)
+    pending = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = step(chunk)
+            pending += len(chunk)
+            if pending >= flush_size:
+                data += flush()
+                pending = 0
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def send_precompressed(directory: str, filename: str):
+    '''
+    Send the precompressed variant of a static file accepted by the client
+
+    returns None if the client accepts no encoding or the variant does not exist
+    '''
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return None
+    # relative directories are relative to the app like in send_from_directory
+    variant = safe_join(path.join(current_app.root_path, directory),
+                        filename + extensions[encoding])
+    if variant is None or not path.isfile(variant):
+        return None
+    response = send_from_directory(directory, filename + extensions[encoding],
+                                   mimetype=mimetypes.guess_type(filename)[0])
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def precompress_directory(directory: str, compressible: set) -> int:
+    '''
+    Write maximally compressed gzip (and brotli) variants next to compressible files
+
+    variants which are up to date or not smaller than their file are skipped,
+    returns the number of written variants
+    '''
+    written = 0
+    for filename in listdir(directory):
+        source = path.join(directory, filename)
+        if not path.isfile(source) or mimetypes.guess_type(filename)[0] not in compressible:
+            continue
+        for encoding, extension in extensions.items():
+            if encoding == 'br' and brotli is None:
+                continue
+            target = source + extension
+            if path.isfile(target) and path.getmtime(target) >= path.getmtime(source):
+                continue
+            with open(source, 'rb') as f:
+                data = f.read()
+            compressed = compress(data, encoding, 11 if encoding == 'br' else 9)
+            if len(compressed) >= len(data):
+                continue
+            with open(target, 'wb') as f:
+                f.write(compressed)
+            written += 1
+    return written
+
+
+def setup_compression(app):
+    '''
+    setup_compression(app)
+
+    compress responses of COMPRESS_MIMETYPES types with brotli or gzip as
+    negotiated with the client, whole bodies are compressed only if they are
+    at least COMPRESS_MIN_SIZE bytes and streamed bodies are compressed on the fly
+    '''
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code < 200 or response.status_code in (204, 206, 304)
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in app.config['COMPRESS_MIMETYPES']):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate_encoding()
+        if encoding is None:
+            return response
+        level = app.config['COMPRESS_BROTLI_QUALITY'] if encoding == 'br' \
+            else app.config['COMPRESS_GZIP_LEVEL']
+        if response.is_streamed:
+            response.response = compress_stream(
+                response.response, encoding, level, app.config['COMPRESS_STREAM_FLUSH_SIZE'])
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < app.config['COMPRESS_MIN_SIZE']:
+                return response
+            response.set_data(compress(data, encoding, level))
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -12,10 +12,129 @@ class Config(object):
     EMAIL_PATTERN = "^([\w\.\-]+)@([\w\-]+)((\.(\w){2,3})+)$"
     PHONE_PATTERN = "^\+(?:[0-9]){6,14}[0-9]$"
 
+    # database connection pool (PostgreSQL only)
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))  # seconds
+    # recycle connections before the server (or a proxy) closes idle ones
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))  # seconds
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true') == 'true'
+    DB_STATEMENT_TIMEOUT = int(
+        os.environ.get('DB_STATEMENT_TIMEOUT', 0))  # milliseconds, 0 disables it
+    # let PgBouncer pool connections
+    DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', 'false') == 'true'
+
+    # read replicas serving read-only requests
+    SQLALCHEMY_REPLICA_URIS = [uri.strip() for uri in os.environ.get(
+        'DATABASE_REPLICA_URLS', '').split(',') if uri.strip()]
+    # clients read from primary for this window after writing
+    REPLICA_READ_YOUR_WRITES_WINDOW = 5  # seconds
+
+    # seconds anonymous responses can be served by shared caches (CDN) without revalidation
+    HTTP_CACHE_MAX_AGE = 10
+
+    # anonymous feed pages cache, "memory", "redis" or an import path. writes only
+    # clear the memory cache of the process handling them, other workers serve
+    # stale pages for up to RESPONSE_CACHE_TTL, so redis is used when it is configured
+    RESPONSE_CACHE_REDIS_URL = os.environ.get('REDIS_URL')
+    RESPONSE_CACHE_BACKEND = os.environ.get(
+        'RESPONSE_CACHE_BACKEND', 'redis' if RESPONSE_CACHE_REDIS_URL else 'memory')
+    RESPONSE_CACHE_SIZE = 512
+    RESPONSE_CACHE_TTL = 30  # seconds
+
+    # where uploads are stored, "local" (UPLOAD_FOLDER), "s3" (requires boto3)
+    # or an import path
+    UPLOAD_STORAGE = os.environ.get('UPLOAD_STORAGE', 'local')
     UPLOAD_FOLDER = "uploads"
+    # S3 compatible storage, endpoint url is only needed for non AWS services (MinIO, ...)
+    S3_BUCKET = os.environ.get('S3_BUCKET')
+    S3_PREFIX = 'uploads/'
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+    S3_REGION = os.environ.get('S3_REGION')
+    S3_ACCESS_KEY_ID = os.environ.get('S3_ACCESS_KEY_ID')
+    S3_SECRET_ACCESS_KEY = os.environ.get('S3_SECRET_ACCESS_KEY')
+    # uploads are redirected to this url (e.g. a CDN) if set, else to presigned urls
+    S3_PUBLIC_URL = os.environ.get('S3_PUBLIC_URL')
+    S3_URL_EXPIRES = 60 * 60  # seconds
+    # files larger than the threshold are uploaded in parts of chunk size
+    S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024  # bytes
+    S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024  # bytes
     ALLOWED_EXTENSIONS = {'png', 'jpg'}
+    # resized variants of uploaded images, fitting in squares of these sizes
+    IMAGE_VARIANTS = {'small': 96, 'medium': 480}
+    # also write WebP variants (if supported by Pillow)
+    IMAGE_WEBP = True
+    # larger images are rejected before being decoded (decompression bombs)
+    IMAGE_MAX_PIXELS = 40 * 1000 * 1000
+    # threads generating variants, 0 generates them on the request path
+    IMAGE_WORKERS = 2
+    # uploads are named after their content so clients can cache them forever
+    UPLOAD_MAX_AGE = 365 * 24 * 60 * 60  # seconds
+    # "app" sends uploads itself, "x-accel" (nginx) or "x-sendfile" (apache, lighttpd)
+    # let the front proxy send them
+    UPLOAD_SERVE_MODE = os.environ.get('UPLOAD_SERVE_MODE', 'app')
+    # internal nginx location mapped to UPLOAD_FOLDER (local storage)
+    UPLOAD_ACCEL_PREFIX = '/protected-uploads/'
+    # total size of files a user can upload
+    UPLOAD_QUOTA = 50 * 1024 * 1024  # bytes
+    # unreferenced uploads are garbage collected after this period
+    UPLOAD_GC_GRACE = 24 * 60 * 60  # seconds
     MAX_CONTENT_LENGTH = 5 * 1024 * 1024
 
+    # compress responses of these types (brotli if installed, else gzip)
+    COMPRESS_MIMETYPES = {'application/json', 'application/x-ndjson',
+                          'text/html', 'text/css', 'text/plain',
+                          'application/javascript', 'image/svg+xml'}
+    COMPRESS_MIN_SIZE = 1024  # bytes, smaller bodies are not worth it
+    COMPRESS_GZIP_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 4  # fast enough for dynamic responses
+    COMPRESS_STREAM_FLUSH_SIZE = 16 * 1024  # bytes of streamed input per flush
+
+    # "orjson" (faster, used if installed) or "stdlib"
+    JSON_BACKEND = os.environ.get('JSON_BACKEND', 'orjson')
+    # datetimes are written as "http" dates (RFC 822) or "iso" (ISO 8601) strings
+    JSON_DATETIME_FORMAT = 'http'
+    # pretty printing is only used in debug mode
+    JSONIFY_PRETTYPRINT_REGULAR = False
+
+    # "jose" or "pyjwt" (faster, requires PyJWT to be installed)
+    JWT_BACKEND = os.environ.get('JWT_BACKEND', 'jose')
+    # number of verified tokens kept in memory
+    JWT_CACHE_SIZE = 1024
+    # roles permissions are cached per process, changes made by other processes
+    # are picked up within this period
+    ROLES_CACHE_TTL = 60  # seconds
+
+    # bcrypt cost factor, passwords are rehashed on login when it changes
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    # passwords are hashed on a bounded pool shared by the threads of a worker
+    # process, extra requests get 503. only reachable with more request threads
+    # than workers + queue depth (Procfile runs 12, within the database pool)
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_QUEUE_DEPTH = 8
+
+    # in-process suggestions index (used when not on PostgreSQL)
+    SUGGEST_HOT_SET_SIZE = 1000
+    SUGGEST_TTL = 60  # seconds
+
+    # notifications are inserted in batches by a background thread
+    NOTIFICATIONS_BACKEND = 'thread'
+    NOTIFICATIONS_BATCH_SIZE = 100
+    NOTIFICATIONS_BATCH_INTERVAL = 0.5  # seconds
+
+    # mail outbox, queued messages are sent by a background thread
+    MAIL_OUTBOX_WORKER = True
+    MAIL_SEND_INTERVAL = 10  # seconds
+    MAIL_BATCH_SIZE = 50
+    MAIL_MAX_ATTEMPTS = 5
+    MAIL_RETRY_BACKOFF = 30  # seconds, doubled after every failed attempt
+    # messages claimed by a sender which did not report back are sent again after this
+    MAIL_CLAIM_TIMEOUT = 5 * 60  # seconds
+    # sent and failed messages are deleted after this period
+    MAIL_RETENTION = 30 * 24 * 60 * 60  # seconds
+    # collapse reports queued within MAIL_SEND_INTERVAL into one digest email
+    MAIL_DIGEST = False
+
 
 class ProductionConfig(Config):
     ''' Extend base config with production config '''
@@ -42,5 +161,20 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + \
         os.path.join(basedir, 'tests/test.db')
 
+    # minimum bcrypt cost, keeps tests fast
+    BCRYPT_LOG_ROUNDS = 4
+
+    # insert notifications on the request path to keep tests deterministic
+    NOTIFICATIONS_BACKEND = 'sync'
+
+    # tests send queued messages explicitly
+    MAIL_OUTBOX_WORKER = False
+
+    # generate image variants on the request path to keep tests deterministic
+    IMAGE_WORKERS = 0
+
+    # one process, whatever REDIS_URL is
+    RESPONSE_CACHE_BACKEND = 'memory'
+
     # Dummy data, emails will not be sent as long as TESTING is True
     MAIL_DEFAULT_SENDER = 'any'
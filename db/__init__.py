@@ -1,7 +1,156 @@
-from flask_sqlalchemy import SQLAlchemy
+import random
+from time import perf_counter
+from threading import Lock
+from flask import request, current_app, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_migrate import Migrate
+from itsdangerous import TimestampSigner, BadSignature
+from sqlalchemy import event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, NullPool
 
-db = SQLAlchemy()
+# safe methods, requests using them never write
+READ_ONLY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# cookie (or header for clients without cookies) pinning a client to primary after writing
+PRIMARY_PIN_COOKIE = 'primary_pin'
+PRIMARY_PIN_HEADER = 'X-Primary-Pin'
+
+
+def get_pin_signer() -> TimestampSigner:
+    return TimestampSigner(current_app.config['SECRET_KEY'], salt='primary-pin')
+
+
+def is_pinned_to_primary() -> bool:
+    '''
+    Check if the client of the current request wrote within REPLICA_READ_YOUR_WRITES_WINDOW seconds
+
+    the pin is signed and carries the time of the write, so it is honored by
+    every worker and survives token changes (register, login)
+    '''
+    pin = request.cookies.get(PRIMARY_PIN_COOKIE) or request.headers.get(PRIMARY_PIN_HEADER)
+    if not pin:
+        return False
+    try:
+        get_pin_signer().unsign(
+            pin, max_age=current_app.config['REPLICA_READ_YOUR_WRITES_WINDOW'])
+    except BadSignature:
+        # tampered or expired
+        return False
+    return True
+
+
+def is_read_only_request() -> bool:
+    '''
+    Check if the current request can be served by a replica
+
+    it must use a safe method and its client must not be pinned to primary,
+    so clients always read their own writes
+    '''
+    if not has_request_context() or request.method not in READ_ONLY_METHODS:
+        return False
+    return not is_pinned_to_primary()
+
+
+class RoutingSession(SignallingSession):
+    '''
+    Session sending queries of read-only requests to a read replica
+
+    replicas are the binds whose key starts with "replica", one of them is
+    picked per session. writes and other requests go to the primary database
+    '''
+
+    def __init__(self, db, **options):
+        self.replica = None
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not self._flushing and is_read_only_request():
+            if self.replica is None:
+                app = current_app._get_current_object()
+                replicas = [key for key in app.config.get('SQLALCHEMY_BINDS') or {}
+                            if key.startswith('replica')]
+                if replicas:
+                    self.replica = db.get_engine(app, bind=random.choice(replicas))
+            if self.replica is not None:
+                return self.replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    ''' SQLAlchemy service using RoutingSession '''
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+class TimedQueuePool(QueuePool):
+    ''' QueuePool recording how long checkouts wait for a connection '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_lock = Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = perf_counter() - start
+            with self.stats_lock:
+                self.checkouts += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+
+
+def get_engine_options(config) -> dict:
+    '''
+    Build SQLAlchemy engine options from DB_* config
+
+    pool options only apply to PostgreSQL. in PgBouncer mode connections are
+    not pooled by the app (PgBouncer does it) and the statement timeout is set
+    per transaction, as session settings leak between PgBouncer clients
+    '''
+    if make_url(config['SQLALCHEMY_DATABASE_URI']).get_backend_name() != 'postgresql':
+        return {}
+    options = {
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+    }
+    if config['DB_PGBOUNCER']:
+        options['poolclass'] = NullPool
+    else:
+        options.update(poolclass=TimedQueuePool,
+                       pool_size=config['DB_POOL_SIZE'],
+                       max_overflow=config['DB_MAX_OVERFLOW'],
+                       pool_timeout=config['DB_POOL_TIMEOUT'])
+        if config['DB_STATEMENT_TIMEOUT']:
+            options['connect_args'] = {
+                'options': '-c statement_timeout=%i' % config['DB_STATEMENT_TIMEOUT']}
+    return options
+
+
+def get_pool_stats() -> dict:
+    ''' Return connection pool usage of the current app engine '''
+    pool = db.engine.pool
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(),
+                     checked_in=pool.checkedin(),
+                     checked_out=pool.checkedout(),
+                     overflow=pool.overflow())
+    if isinstance(pool, TimedQueuePool):
+        with pool.stats_lock:
+            stats.update(checkouts=pool.checkouts,
+                         wait_total=pool.wait_total,
+                         wait_max=pool.wait_max,
+                         wait_avg=pool.wait_total / pool.checkouts if pool.checkouts else 0.0)
+    return stats
 
 
 def setup_db(app):
@@ -11,9 +160,36 @@ def setup_db(app):
     binds a flask application and a SQLAlchemy service
     '''
 
+    # register replicas as binds named replica_0, replica_1, ...
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for index, uri in enumerate(app.config['SQLALCHEMY_REPLICA_URIS']):
+        binds['replica_%i' % index] = uri
+    app.config['SQLALCHEMY_BINDS'] = binds or None
+
+    options = get_engine_options(app.config)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **options, **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})}
     db.app = app
     db.init_app(app)
 
+    if options and app.config['DB_PGBOUNCER'] and app.config['DB_STATEMENT_TIMEOUT']:
+        @event.listens_for(db.get_engine(app), 'begin')
+        def set_statement_timeout(conn):
+            conn.exec_driver_sql('SET LOCAL statement_timeout = %i' %
+                                 app.config['DB_STATEMENT_TIMEOUT'])
+
+    # pin clients who wrote to primary to route their next reads there (if replicas are used)
+    @app.after_request
+    def track_writes(response):
+        if app.config['SQLALCHEMY_BINDS'] and request.method not in READ_ONLY_METHODS \
+                and response.status_code < 400:
+            pin = get_pin_signer().sign('1').decode()
+            response.set_cookie(PRIMARY_PIN_COOKIE, pin, httponly=True, samesite='Lax',
+                                max_age=app.config['REPLICA_READ_YOUR_WRITES_WINDOW'],
+                                secure=request.is_secure)
+            response.headers[PRIMARY_PIN_HEADER] = pin
+        return response
+
     # do not use migrations in test environment
     if app.config['TESTING'] is True:
         db.create_all()
@@ -0,0 +1,38 @@
+from flask import current_app
+from sqlalchemy import select
+from db import db
+from db.models import Question, Answer
+
+# exportable models by name
+exportables = {
+    'questions': Question,
+    'answers': Answer
+}
+
+
+def get_export_encoder():
+    ''' Return a compact JSON encoder of the current app writing datetimes as ISO 8601 strings '''
+    encoder_class = current_app.json_encoder
+    encoder_class = type(encoder_class.__name__, (encoder_class,), {
+                         'datetime_format': 'iso'})
+    return encoder_class(sort_keys=False, separators=(',', ':'))
+
+
+def export_ndjson(kind: str, batch_size: int = 1000):
+    '''
+    Yield all rows of a table as newline delimited JSON
+
+    rows are read with a server side cursor (where supported) in batches of
+    batch_size and every batch is yielded as one chunk, so memory does not
+    grow with the table size
+    '''
+    table = exportables[kind].__table__
+    encoder = get_export_encoder()
+    stmt = select(table).order_by(table.c.id).execution_options(
+        stream_results=True, max_row_buffer=batch_size)
+    result = db.session.execute(stmt)
+    try:
+        for rows in result.partitions(batch_size):
+            yield ''.join(encoder.encode(dict(row._mapping)) + '\n' for row in rows)
+    finally:
+        result.close()
@@ -1,10 +1,13 @@
-from auth import get_jwt_sub
+from auth import get_jwt_sub, get_jwt_uid
+from auth.passwords import get_password_hasher
+from media import variant_name
 from sqlalchemy.orm import backref
 from db import db
-from flask import request
-from sqlalchemy import Column, Integer, ForeignKey, DateTime, VARCHAR, LargeBinary, exc, Text, Boolean
-from datetime import datetime
-import bcrypt
+from flask import request, current_app, has_request_context, _request_ctx_stack
+from sqlalchemy import Column, Integer, ForeignKey, DateTime, VARCHAR, LargeBinary, exc, Text, Boolean, Index, UniqueConstraint, func, select, update, or_, and_, literal_column, literal, event, false
+from sqlalchemy.dialects import postgresql, sqlite
+from datetime import datetime, timedelta
+from time import monotonic
 
 
 class BaseModel:
@@ -25,6 +28,7 @@ class BaseModel:
     def delete(self):
         ''' delete item from db '''
         try:
+            self.on_delete()
             db.session.delete(self)
             db.session.commit()
         except exc.SQLAlchemyError as e:
@@ -35,11 +39,20 @@ class BaseModel:
         ''' insert item into db '''
         try:
             db.session.add(self)
+            self.on_insert()
             db.session.commit()
         except exc.SQLAlchemyError as e:
             db.session.rollback()
             raise e
 
+    def on_insert(self):
+        ''' hook called within the insert transaction (used to maintain counters) '''
+        pass
+
+    def on_delete(self):
+        ''' hook called within the delete transaction (used to maintain counters) '''
+        pass
+
     def format(self):
         ''' return data as a dict witch can be seralized '''
         pass
@@ -69,6 +82,145 @@ class AnswerVote(db.Model):
         "answers_votes", cascade="all, delete-orphan", lazy="dynamic"))
 
 
+def increment(model, id: int, **deltas):
+    '''
+    Atomically add deltas to counter columns of a row
+
+    the update runs as "SET column = column + delta" within the current
+    transaction, so concurrent updates never overwrite each other
+    '''
+    values = {getattr(model, column): getattr(model, column) + delta
+              for column, delta in deltas.items() if delta}
+    if values:
+        model.query.filter_by(id=id).update(
+            values, synchronize_session=False)
+
+
+def shift_votes(model, id: int, added: bool = None, removed: bool = None) -> tuple:
+    '''
+    Update upvotes and downvotes counters of a row after adding and/or removing a vote
+
+    returns the new (upvotes, downvotes) tallies, on PostgreSQL they are
+    returned by the update statement itself
+    '''
+    deltas = {'upvotes': 0, 'downvotes': 0}
+    if added is not None:
+        deltas['upvotes' if added else 'downvotes'] += 1
+    if removed is not None:
+        deltas['upvotes' if removed else 'downvotes'] -= 1
+    stmt = update(model).where(model.id == id).values(
+        upvotes=model.upvotes + deltas['upvotes'],
+        downvotes=model.downvotes + deltas['downvotes'])
+    tallies = select(model.upvotes, model.downvotes).where(model.id == id)
+    if db.engine.dialect.name == 'postgresql':
+        return tuple(db.session.execute(stmt.returning(model.upvotes, model.downvotes)).first())
+    if any(deltas.values()):
+        db.session.execute(stmt)
+    return tuple(db.session.execute(tallies).first())
+
+
+def write_vote(model, vote_model, target: str, id: int, user_id: int, vote: bool = None) -> tuple:
+    '''
+    Set a user vote on a question or an answer (remove it if vote is None)
+    and update the target counters within one transaction
+
+    the vote is written with a single dialect aware "INSERT ... ON CONFLICT DO UPDATE"
+    (or "DELETE") statement, so concurrent votes from the same user never raise
+    IntegrityError. returns the new (upvotes, downvotes) tallies of the target
+    '''
+    table = vote_model.__table__
+    where = and_(table.c[target] == id, table.c.user_id == user_id)
+    postgres = db.engine.dialect.name == 'postgresql'
+    try:
+        if not postgres:
+            # a no-op write takes the sqlite write lock before the previous vote
+            # is read, so concurrent votes from the same user are serialized
+            db.session.execute(table.update().where(
+                where).values(vote=table.c.vote))
+            previous = db.session.execute(
+                select(table.c.vote).where(where)).scalar()
+
+        if vote is None:
+            stmt = table.delete().where(where)
+            if postgres:
+                previous = db.session.execute(
+                    stmt.returning(table.c.vote)).scalar()
+            elif previous is not None:
+                db.session.execute(stmt)
+        else:
+            insert = postgresql.insert if postgres else sqlite.insert
+            stmt = insert(table).values({target: id, 'user_id': user_id, 'vote': vote})
+            # only touch the existing row if the vote has changed
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c[target], table.c.user_id],
+                set_={'vote': stmt.excluded.vote},
+                where=table.c.vote != stmt.excluded.vote)
+            if postgres:
+                # xmax is zero for inserted rows, no row is returned if the vote is unchanged
+                row = db.session.execute(stmt.returning(
+                    literal_column('xmax = 0'))).first()
+                previous = vote if row is None else (
+                    None if row[0] else not vote)
+            elif previous != vote:
+                db.session.execute(stmt)
+
+        if previous == vote:
+            tallies = shift_votes(model, id)
+        else:
+            tallies = shift_votes(model, id, added=vote, removed=previous)
+        db.session.commit()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        raise e
+    return tallies
+
+
+def get_current_user():
+    '''
+    Return the user of the JWT that is accessing the current request.
+    If no JWT is present (or outside a request), ``None`` is returned.
+
+    the user is loaded at most once per request (by id if the JWT carries it)
+    and shared by endpoints and models
+    '''
+    if not has_request_context():
+        return None
+    ctx = _request_ctx_stack.top
+    if not hasattr(ctx, 'user'):
+        user_id, username = get_jwt_uid(), get_jwt_sub()
+        if user_id is not None:
+            ctx.user = User.query.get(user_id)
+        elif username is not None:
+            ctx.user = User.query.filter_by(username=username).first()
+        else:
+            ctx.user = None
+    return ctx.user
+
+
+def get_current_user_id() -> int:
+    '''
+    Return the id of the user of the JWT that is accessing the current request.
+    If no JWT is present, ``None`` is returned.
+
+    the id carried by the JWT is used when present, so no query is needed
+    '''
+    user_id = get_jwt_uid()
+    if user_id is not None:
+        return user_id
+    user = get_current_user()
+    return user.id if user else None
+
+
+def get_viewer_votes(vote_model, target: str, ids: list, viewer_id: int = None) -> dict:
+    ''' Return {target id: vote} of the viewer votes on many targets using one query '''
+    if viewer_id is None:
+        return {}
+    target_column = getattr(vote_model, target)
+    rows = db.session.query(target_column, vote_model.vote).filter(
+        vote_model.user_id == viewer_id, target_column.in_(ids))
+    return dict(rows.all())
+
+
 class User(db.Model, BaseModel):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
@@ -84,6 +236,13 @@ class User(db.Model, BaseModel):
     phone = Column(VARCHAR(50), nullable=True, unique=True)
     avatar = Column(Text, nullable=True)
     created_at = Column(DateTime(), default=datetime.utcnow, nullable=False)
+    # version stamp, bumped by every update including counters
+    updated_at = Column(DateTime(), default=datetime.utcnow, onupdate=datetime.utcnow,
+                        nullable=False)
+    questions_count = Column(Integer, default=0,
+                             server_default='0', nullable=False)
+    answers_count = Column(Integer, default=0,
+                           server_default='0', nullable=False)
     questions = db.relationship(
         'Question', backref='user', order_by='desc(Question.created_at)', lazy=True, cascade='all')
     answers = db.relationship(
@@ -96,8 +255,7 @@ class User(db.Model, BaseModel):
         self.last_name = last_name
         self.email = email
         self.username = username
-        self.password = bcrypt.hashpw(
-            bytes(password, 'utf-8'), bcrypt.gensalt(12))
+        self.password = get_password_hasher().hash(password)
         self.role_id = role_id
         self.job = job
         self.bio = bio
@@ -106,7 +264,11 @@ class User(db.Model, BaseModel):
 
     def checkpw(self, password: str):
         ''' Check if the provided password is equal to user password '''
-        return bcrypt.checkpw(bytes(password, 'utf-8'), self.password)
+        return get_password_hasher().check(password, self.password)
+
+    def needs_rehash(self) -> bool:
+        ''' Check if user password was hashed with a different cost than the configured one '''
+        return get_password_hasher().needs_rehash(self.password)
 
     def set_pw(self, password: str):
         '''
@@ -114,41 +276,72 @@ class User(db.Model, BaseModel):
 
         password is hashed first before getting assigned to user
         '''
-        self.password = bcrypt.hashpw(
-            bytes(password, 'utf-8'), bcrypt.gensalt(12))
+        self.password = get_password_hasher().hash(password)
 
     def format(self):
-        # prepend uploads endpoint to self.avatar
-        avatar = self.avatar
-        if (avatar):
-            try:
-                # will fail if called outside an endpoint
-                avatar = request.root_url + 'uploads/' + avatar
-            except RuntimeError:
-                pass
-
-        return {
-            'first_name': self.first_name,
-            'last_name': self.last_name,
-            'full_name': '%s %s' % (self.first_name, self.last_name),
-            'username': self.username,
-            'job': self.job,
-            'bio': self.bio,
-            'avatar': avatar,
-            'questions_count': len(self.questions),
-            'answers_count': len(self.answers),
-            'created_at': self.created_at
-        }
+        return User.format_many([self])[0]
+
+    @classmethod
+    def format_many(cls, users: list) -> list:
+        ''' Format a list of users '''
+        data = []
+        for user in users:
+            # prepend uploads endpoint to the resized variants of user.avatar
+            avatar = avatar_medium = user.avatar
+            if (avatar):
+                avatar = variant_name(user.avatar, 'small')
+                avatar_medium = variant_name(user.avatar, 'medium')
+                try:
+                    # will fail if called outside an endpoint
+                    avatar = request.root_url + 'uploads/' + avatar
+                    avatar_medium = request.root_url + 'uploads/' + avatar_medium
+                except RuntimeError:
+                    pass
+
+            data.append({
+                'first_name': user.first_name,
+                'last_name': user.last_name,
+                'full_name': '%s %s' % (user.first_name, user.last_name),
+                'username': user.username,
+                'job': user.job,
+                'bio': user.bio,
+                'avatar': avatar,
+                'avatar_medium': avatar_medium,
+                'questions_count': user.questions_count,
+                'answers_count': user.answers_count,
+                'created_at': user.created_at
+            })
+        return data
+
+    @classmethod
+    def format_authors(cls, items: list) -> dict:
+        ''' Load and format the authors of a list of questions or answers, return {user id: user data} '''
+        users = User.query.filter(
+            User.id.in_({item.user_id for item in items})).all()
+        return dict(zip([user.id for user in users], User.format_many(users)))
 
 
 class Question(db.Model, BaseModel):
     __tablename__ = 'questions'
+    # composite indexes backing keyset pagination on (created_at, id)
+    __table_args__ = (
+        Index('ix_questions_created_at_id', 'created_at', 'id'),
+        Index('ix_questions_user_id_created_at_id',
+              'user_id', 'created_at', 'id'),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     content = Column(Text, nullable=False)
     created_at = Column(DateTime(), default=datetime.utcnow, nullable=False)
     accepted_answer = Column(Integer, ForeignKey(
         'answers.id', use_alter=True, ondelete="SET NULL"), nullable=True)
+    upvotes = Column(Integer, default=0, server_default='0', nullable=False)
+    downvotes = Column(Integer, default=0, server_default='0', nullable=False)
+    # version stamp, bumped by edits, votes and answers
+    updated_at = Column(DateTime(), default=datetime.utcnow, onupdate=datetime.utcnow,
+                        nullable=False)
+    answers_count = Column(Integer, default=0,
+                           server_default='0', nullable=False)
     answers = db.relationship('Answer', backref='question',
                               order_by='desc(Answer.created_at)', lazy=True, foreign_keys='Answer.question_id', cascade='all')
 
@@ -156,25 +349,13 @@ class Question(db.Model, BaseModel):
         self.user_id = user_id
         self.content = content
 
-    def vote(self, user: User, vote: bool):
-        ''' upvote or downvote a question '''
-        if self.hasvoted(user):
-            # update the vote itself if the user has already voted
-            vote_obj = self.votes.filter_by(user=user).first()
-            vote_obj.vote = vote
-        else:
-            # working with the association pattern as detailed in the docs
-            # ref: https://docs.sqlalchemy.org/en/14/orm/basic_relationships.html
-            vote = QuestionVote(vote=vote)
-            vote.user = user
-            self.votes.append(vote)
-        # update in either cases
-        self.update()
-
-    def unvote(self, user: User):
-        ''' remove specific user vote '''
-        self.votes.filter_by(user=user).delete()
-        self.update()
+    def vote(self, user_id: int, vote: bool) -> tuple:
+        ''' upvote or downvote a question, return the new (upvotes, downvotes) tallies '''
+        return write_vote(Question, QuestionVote, 'question_id', self.id, user_id, vote)
+
+    def unvote(self, user_id: int) -> tuple:
+        ''' remove specific user vote, return the new (upvotes, downvotes) tallies '''
+        return write_vote(Question, QuestionVote, 'question_id', self.id, user_id)
 
     def get_user_vote(self, user: User):
         ''' Returns user vote for the question. None if the user has not voted'''
@@ -187,55 +368,85 @@ class Question(db.Model, BaseModel):
         ''' Check wether a specific user has voted the question '''
         return self.votes.filter_by(user=user).first() is not None
 
+    def answers_updated_at(self) -> tuple:
+        ''' Return the latest version stamps of the question answers and their authors '''
+        return db.session.query(func.max(Answer.updated_at), func.max(User.updated_at)).join(
+            User, User.id == Answer.user_id).filter(Answer.question_id == self.id).one()
+
+    def on_insert(self):
+        increment(User, self.user_id, questions_count=1)
+
+    def on_delete(self):
+        increment(User, self.user_id, questions_count=-1)
+        # answers are deleted in cascade, discount them from their authors
+        rows = db.session.query(Answer.user_id, func.count()).filter(
+            Answer.question_id == self.id).group_by(Answer.user_id)
+        for user_id, count in rows.all():
+            increment(User, user_id, answers_count=-count)
+
     def format(self):
-        curr_user = User.query.filter_by(username=get_jwt_sub()).first()
-        return {
-            'id': self.id,
-            'user': self.user.format(),
-            'content': self.content,
-            'created_at': self.created_at,
-            'accepted_answer': self.accepted_answer,
-            'answers_count': len(self.answers),
-            'upvotes': self.votes.filter_by(vote=True).count(),
-            'downvotes': self.votes.filter_by(vote=False).count(),
+        return Question.format_many([self])[0]
+
+    @classmethod
+    def format_many(cls, questions: list) -> list:
+        '''
+        Format a list of questions
+
+        authors and viewer votes are fetched for all questions at once
+        instead of running several queries per question
+        '''
+        if not questions:
+            return []
+        ids = [question.id for question in questions]
+        viewer_id = get_current_user_id()
+        users = User.format_authors(questions)
+        viewer_votes = get_viewer_votes(
+            QuestionVote, 'question_id', ids, viewer_id)
+
+        return [{
+            'id': question.id,
+            'user': users[question.user_id],
+            'content': question.content,
+            'created_at': question.created_at,
+            'accepted_answer': question.accepted_answer,
+            'answers_count': question.answers_count,
+            'upvotes': question.upvotes,
+            'downvotes': question.downvotes,
             # viewer vote will be True if upvote, False if downvote and None if the viewer has not voted
-            'viewer_vote': self.get_user_vote(curr_user) if curr_user else None
-        }
+            'viewer_vote': viewer_votes.get(question.id)
+        } for question in questions]
 
 
 class Answer(db.Model, BaseModel):
     __tablename__ = 'answers'
+    __table_args__ = (
+        Index('ix_answers_question_id_created_at_id',
+              'question_id', 'created_at', 'id'),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     content = Column(Text, nullable=False)
     created_at = Column(DateTime(), default=datetime.utcnow, nullable=False)
 
     question_id = Column(Integer, ForeignKey('questions.id'), nullable=False)
+    upvotes = Column(Integer, default=0, server_default='0', nullable=False)
+    downvotes = Column(Integer, default=0, server_default='0', nullable=False)
+    # version stamp, bumped by edits, votes and answers
+    updated_at = Column(DateTime(), default=datetime.utcnow, onupdate=datetime.utcnow,
+                        nullable=False)
 
     def __init__(self, user_id: int, question_id: int, content: str):
         self.user_id = user_id
         self.content = content
         self.question_id = question_id
 
-    def vote(self, user: User, vote: bool):
-        ''' upvote or downvote a question '''
-        if self.hasvoted(user):
-            # update the vote itself if the user has already voted
-            vote_obj = self.votes.filter_by(user=user).first()
-            vote_obj.vote = vote
-        else:
-            # working with the association pattern as detailed in the docs
-            # ref: https://docs.sqlalchemy.org/en/14/orm/basic_relationships.html
-            vote = AnswerVote(vote=vote)
-            vote.user = user
-            self.votes.append(vote)
-        # update in either cases
-        self.update()
-
-    def unvote(self, user: User):
-        ''' remove specific user vote '''
-        self.votes.filter_by(user=user).delete()
-        self.update()
+    def vote(self, user_id: int, vote: bool) -> tuple:
+        ''' upvote or downvote a answer, return the new (upvotes, downvotes) tallies '''
+        return write_vote(Answer, AnswerVote, 'answer_id', self.id, user_id, vote)
+
+    def unvote(self, user_id: int) -> tuple:
+        ''' remove specific user vote, return the new (upvotes, downvotes) tallies '''
+        return write_vote(Answer, AnswerVote, 'answer_id', self.id, user_id)
 
     def get_user_vote(self, user: User):
         ''' Returns user vote for the question. None if the user has not voted'''
@@ -248,19 +459,80 @@ class Answer(db.Model, BaseModel):
         ''' Check wether a specific user has voted the question '''
         return self.votes.filter_by(user=user).first() is not None
 
+    def on_insert(self):
+        increment(User, self.user_id, answers_count=1)
+        increment(Question, self.question_id, answers_count=1)
+
+    def on_delete(self):
+        increment(User, self.user_id, answers_count=-1)
+        increment(Question, self.question_id, answers_count=-1)
+
     def format(self):
-        curr_user = User.query.filter_by(username=get_jwt_sub()).first()
-        return {
-            'id': self.id,
-            'user': self.user.format(),
-            'question_id': self.question_id,
-            'content': self.content,
-            'created_at': self.created_at,
+        return Answer.format_many([self])[0]
+
+    @classmethod
+    def format_many(cls, answers: list) -> list:
+        ''' Format a list of answers fetching authors and viewer votes at once '''
+        if not answers:
+            return []
+        ids = [answer.id for answer in answers]
+        viewer_id = get_current_user_id()
+        users = User.format_authors(answers)
+        viewer_votes = get_viewer_votes(
+            AnswerVote, 'answer_id', ids, viewer_id)
+
+        return [{
+            'id': answer.id,
+            'user': users[answer.user_id],
+            'question_id': answer.question_id,
+            'content': answer.content,
+            'created_at': answer.created_at,
             # viewer vote will be True if upvote, False if downvote and None if the viewer has not voted
-            'upvotes': self.votes.filter_by(vote=True).count(),
-            'downvotes': self.votes.filter_by(vote=False).count(),
-            'viewer_vote': self.get_user_vote(curr_user) if curr_user else None
+            'upvotes': answer.upvotes,
+            'downvotes': answer.downvotes,
+            'viewer_vote': viewer_votes.get(answer.id)
+        } for answer in answers]
+
+
+def reconcile_counters() -> int:
+    '''
+    Recompute denormalized counters from source rows
+
+    returns the number of rows which had drifted counters
+    '''
+    def count(model, column, id, *criteria):
+        return select(func.count()).select_from(model).where(
+            column == id, *criteria).scalar_subquery()
+
+    counters = {
+        User: {
+            User.questions_count: count(Question, Question.user_id, User.id),
+            User.answers_count: count(Answer, Answer.user_id, User.id)
+        },
+        Question: {
+            Question.answers_count: count(Answer, Answer.question_id, Question.id),
+            Question.upvotes: count(QuestionVote, QuestionVote.question_id, Question.id,
+                                    QuestionVote.vote.is_(True)),
+            Question.downvotes: count(QuestionVote, QuestionVote.question_id, Question.id,
+                                      QuestionVote.vote.is_(False))
+        },
+        Answer: {
+            Answer.upvotes: count(AnswerVote, AnswerVote.answer_id, Answer.id,
+                                  AnswerVote.vote.is_(True)),
+            Answer.downvotes: count(AnswerVote, AnswerVote.answer_id, Answer.id,
+                                    AnswerVote.vote.is_(False))
         }
+    }
+    drifted = 0
+    try:
+        for model, values in counters.items():
+            drifted += model.query.filter(or_(*[column != value for column, value in values.items()])).update(
+                values, synchronize_session=False)
+        db.session.commit()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        raise e
+    return drifted
 
 
 roles_permissions = db.Table('roles_permissions',
@@ -269,6 +541,19 @@ roles_permissions = db.Table('roles_permissions',
                              Column('permission_id', Integer, ForeignKey('permissions.id'), nullable=False))
 
 
+# in-process cache of role id -> permission names and role name -> role id,
+# cleared whenever a role or a permission is changed by this process and
+# every ROLES_CACHE_TTL seconds, so other processes pick changes up
+roles_cache = {'permissions': {}, 'ids': {}, 'loaded_at': monotonic()}
+
+
+def get_roles_cache() -> dict:
+    ''' Return the roles cache, cleared first if it has expired '''
+    if monotonic() - roles_cache['loaded_at'] > current_app.config['ROLES_CACHE_TTL']:
+        clear_roles_cache()
+    return roles_cache
+
+
 class Role(db.Model, BaseModel):
     __tablename__ = 'roles'
     id = Column(Integer, primary_key=True)
@@ -279,6 +564,27 @@ class Role(db.Model, BaseModel):
     def __init__(self, name: str):
         self.name = name
 
+    @classmethod
+    def get_permissions(cls, role_id: int) -> list:
+        ''' Return permission names of a role, cached after the first call '''
+        permissions = get_roles_cache()['permissions']
+        if role_id not in permissions:
+            role = Role.query.get(role_id)
+            permissions[role_id] = [
+                permission.name for permission in role.permissions] if role else []
+        return permissions[role_id]
+
+    @classmethod
+    def get_id(cls, name: str) -> int:
+        ''' Return id of a role by its name, cached after the first call '''
+        ids = get_roles_cache()['ids']
+        if name not in ids:
+            role = Role.query.filter_by(name=name).one_or_none()
+            if role is None:
+                return None
+            ids[name] = role.id
+        return ids[name]
+
     def format(self):
         return {
             'id': self.id,
@@ -301,8 +607,25 @@ class Permission(db.Model, BaseModel):
         }
 
 
+def clear_roles_cache(*args):
+    ''' Invalidate cached roles permissions '''
+    roles_cache['permissions'].clear()
+    roles_cache['ids'].clear()
+    roles_cache['loaded_at'] = monotonic()
+
+
+# dirty roles are flushed even if only their permissions have changed
+for model in (Role, Permission):
+    for identifier in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, identifier, clear_roles_cache)
+
+
 class Notification(db.Model, BaseModel):
     __tablename__ = 'notifications'
+    __table_args__ = (
+        Index('ix_notifications_user_id_created_at_id',
+              'user_id', 'created_at', 'id'),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     content = Column(Text, nullable=False)
@@ -323,3 +646,212 @@ class Notification(db.Model, BaseModel):
             'is_read': self.is_read,
             'created_at': self.created_at
         }
+
+
+class OutboxMessage(db.Model, BaseModel):
+    __tablename__ = 'mail_outbox'
+    id = Column(Integer, primary_key=True)
+    recipient = Column(VARCHAR(60), nullable=False)
+    subject = Column(Text, nullable=False)
+    body = Column(Text, nullable=False)
+    html = Column(Text, nullable=True)
+    # digestible messages can be collapsed with others into one digest email
+    digest = Column(Boolean, default=False, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(
+        DateTime(), default=datetime.utcnow, nullable=False, index=True)
+    sent_at = Column(DateTime(), nullable=True)
+    # sender which claimed the message last
+    claimed_by = Column(VARCHAR(32), nullable=True, index=True)
+    created_at = Column(DateTime(), default=datetime.utcnow, nullable=False)
+
+    def __init__(self, recipient: str, subject: str, body: str, html: str = None, digest: bool = False):
+        self.recipient = recipient
+        self.subject = subject
+        self.body = body
+        self.html = html
+        self.digest = digest
+
+    def format(self):
+        return {
+            'id': self.id,
+            'recipient': self.recipient,
+            'subject': self.subject,
+            'attempts': self.attempts,
+            'sent_at': self.sent_at,
+            'created_at': self.created_at
+        }
+
+
+class StoredFile(db.Model, BaseModel):
+    '''
+    Reference counted content addressed upload
+
+    files nobody references are garbage collected after a grace period
+    which lets uploaders reference them first
+    '''
+    __tablename__ = 'stored_files'
+    name = Column(VARCHAR(80), primary_key=True)
+    size = Column(Integer, nullable=False)
+    refs = Column(Integer, default=0, server_default='0', nullable=False)
+    # bumped by every upload of the same content
+    uploaded_at = Column(DateTime(), default=datetime.utcnow,
+                         nullable=False, index=True)
+    # resized variants (and their WebP versions) have been generated
+    variants = Column(Boolean, default=False,
+                      server_default=false(), nullable=False)
+    webp = Column(Boolean, default=False, server_default=false(), nullable=False)
+
+    @classmethod
+    def register(cls, name: str, size: int):
+        ''' Record an upload, uploading existing content restarts its grace period '''
+        insert = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+        stmt = insert(cls.__table__).values(
+            name=name, size=size, refs=0, uploaded_at=datetime.utcnow())
+        stmt = stmt.on_conflict_do_update(index_elements=[cls.__table__.c.name],
+                                          set_={'uploaded_at': stmt.excluded.uploaded_at})
+        try:
+            db.session.execute(stmt)
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            db.session.rollback()
+            raise e
+
+    @classmethod
+    def mark_variants(cls, name: str, webp: bool):
+        ''' Record that the resized variants of a file have been generated '''
+        try:
+            cls.query.filter_by(name=name).update(
+                {cls.variants: True, cls.webp: webp}, synchronize_session=False)
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            db.session.rollback()
+            raise e
+
+    @classmethod
+    def retain(cls, name: str) -> bool:
+        ''' Add a reference to a file within the current transaction, False if it is not stored '''
+        return cls.query.filter_by(name=name).update(
+            {cls.refs: cls.refs + 1}, synchronize_session=False) == 1
+
+    @classmethod
+    def release(cls, name: str):
+        ''' Remove a reference to a file within the current transaction '''
+        cls.query.filter(cls.name == name, cls.refs > 0).update(
+            {cls.refs: cls.refs - 1}, synchronize_session=False)
+
+    @classmethod
+    def collect(cls, grace: int, remove=None) -> list:
+        '''
+        Delete records of files unreferenced for grace seconds
+
+        uploads of the files are deleted from the registry along with them.
+        remove(name) is called before each deletion is committed: the record
+        stays locked meanwhile, so a concurrent upload registering the same
+        file waits and then stores it again instead of finding it removed.
+        returns the names of deleted records
+        '''
+        cutoff = datetime.utcnow() - timedelta(seconds=grace)
+        names = [name for name, in db.session.query(cls.name).filter(
+            cls.refs == 0, cls.uploaded_at < cutoff)]
+        deleted = []
+        for name in names:
+            try:
+                # skip files referenced meanwhile
+                if cls.query.filter(cls.name == name, cls.refs == 0, cls.uploaded_at < cutoff).delete(
+                        synchronize_session=False):
+                    Upload.query.filter_by(name=name).delete(
+                        synchronize_session=False)
+                    if remove is not None:
+                        remove(name)
+                    deleted.append(name)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                raise e
+        return deleted
+
+
+class Upload(db.Model, BaseModel):
+    ''' Registry of files uploaded by users, used for ownership checks, quotas and listing '''
+    __tablename__ = 'uploads'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'name'),
+        # backs keyset pagination of user uploads
+        Index('ix_uploads_user_id_created_at_id',
+              'user_id', 'created_at', 'id'),
+    )
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    name = Column(VARCHAR(80), nullable=False)
+    size = Column(Integer, nullable=False)
+    mime = Column(VARCHAR(50), nullable=False)
+    # sha256 hex digest of the content, unknown for uploads predating the registry
+    hash = Column(VARCHAR(64), nullable=True)
+    created_at = Column(DateTime(), default=datetime.utcnow, nullable=False)
+
+    def __init__(self, user_id: int, name: str, size: int, mime: str, hash: str = None):
+        self.user_id = user_id
+        self.name = name
+        self.size = size
+        self.mime = mime
+        self.hash = hash
+
+    @classmethod
+    def owns(cls, user_id: int, name: str) -> bool:
+        ''' Check if a user has uploaded a file '''
+        return db.session.query(cls.query.filter_by(user_id=user_id, name=name).exists()).scalar()
+
+    @classmethod
+    def usage(cls, user_id: int) -> int:
+        ''' Return the total size of files uploaded by a user in bytes '''
+        return db.session.query(func.coalesce(func.sum(cls.size), 0)).filter(
+            cls.user_id == user_id).scalar()
+
+    @classmethod
+    def register(cls, user_id: int, name: str, size: int, mime: str, hash: str, quota: int) -> bool:
+        '''
+        Record an upload of a user if it fits in the quota, False if it does not
+
+        the quota is checked by the insert statement itself and uploads of a
+        user are serialized by locking the user row (SQLite serializes writers),
+        so concurrent uploads can not exceed it. registering an owned file is free
+        '''
+        if cls.owns(user_id, name):
+            return True
+        usage = select(func.coalesce(func.sum(cls.size), 0)).where(
+            cls.user_id == user_id).scalar_subquery()
+        values = select(literal(user_id), literal(name), literal(size), literal(mime),
+                        literal(hash), literal(datetime.utcnow(), DateTime())).where(usage + size <= quota)
+        stmt = cls.__table__.insert().from_select(
+            ['user_id', 'name', 'size', 'mime', 'hash', 'created_at'], values)
+        try:
+            db.session.query(User.id).filter(
+                User.id == user_id).with_for_update().scalar()
+            inserted = db.session.execute(stmt).rowcount == 1
+            db.session.commit()
+        except exc.IntegrityError:
+            # the same file was registered by a concurrent request
+            db.session.rollback()
+            return True
+        except exc.SQLAlchemyError as e:
+            db.session.rollback()
+            raise e
+        return inserted
+
+    def format(self):
+        url = self.name
+        try:
+            # will fail if called outside an endpoint
+            url = request.root_url + 'uploads/' + self.name
+        except RuntimeError:
+            pass
+        return {
+            'id': self.id,
+            'path': self.name,
+            'url': url,
+            'size': self.size,
+            'mime': self.mime,
+            'hash': self.hash,
+            'created_at': self.created_at
+        }
@@ -0,0 +1,75 @@
+from sqlalchemy import DDL, event, func, literal_column
+from sqlalchemy.sql import table, column
+from db import db
+from db.models import Question
+
+# "simple" configuration does no stemming, so it works with any content language
+TS_CONFIG = 'simple'
+
+# PostgreSQL: generated tsvector column backed by a GIN index
+postgres_ddl = [
+    DDL("ALTER TABLE questions ADD COLUMN search_vector tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('%s', content)) STORED" % TS_CONFIG),
+    DDL("CREATE INDEX ix_questions_search_vector ON questions USING gin (search_vector)"),
+]
+
+# SQLite: external content FTS5 table kept in sync by triggers
+sqlite_ddl = [
+    DDL("CREATE VIRTUAL TABLE questions_fts USING fts5"
+        "(content, content='questions', content_rowid='id')"),
+    DDL("CREATE TRIGGER questions_fts_insert AFTER INSERT ON questions BEGIN "
+        "INSERT INTO questions_fts(rowid, content) VALUES (new.id, new.content); END"),
+    DDL("CREATE TRIGGER questions_fts_delete AFTER DELETE ON questions BEGIN "
+        "INSERT INTO questions_fts(questions_fts, rowid, content) "
+        "VALUES ('delete', old.id, old.content); END"),
+    DDL("CREATE TRIGGER questions_fts_update AFTER UPDATE OF content ON questions BEGIN "
+        "INSERT INTO questions_fts(questions_fts, rowid, content) "
+        "VALUES ('delete', old.id, old.content); "
+        "INSERT INTO questions_fts(rowid, content) VALUES (new.id, new.content); END"),
+]
+
+# create search structures along with questions table (used by db.create_all in tests)
+for ddl in postgres_ddl:
+    event.listen(Question.__table__, 'after_create',
+                 ddl.execute_if(dialect='postgresql'))
+for ddl in sqlite_ddl:
+    event.listen(Question.__table__, 'after_create',
+                 ddl.execute_if(dialect='sqlite'))
+event.listen(Question.__table__, 'after_drop', DDL(
+    'DROP TABLE IF EXISTS questions_fts').execute_if(dialect='sqlite'))
+
+questions_fts = table('questions_fts', column('rowid'), column('rank'))
+
+
+def fts5_query(term: str) -> str:
+    ''' Quote every word of term so that FTS5 operators in user input are matched literally '''
+    return ' '.join('"%s"' % word.replace('"', '""') for word in term.split())
+
+
+def search_questions(query, term: str, rank: bool = False):
+    '''
+    Filter a questions query by a full-text search term
+
+    uses the tsvector GIN index on PostgreSQL and the FTS5 table on SQLite
+    (falls back to ILIKE on other databases). if rank is True, questions are
+    ordered by relevance instead of the query original ordering
+    '''
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        vector = literal_column('questions.search_vector')
+        tsquery = func.websearch_to_tsquery(TS_CONFIG, term)
+        query = query.filter(vector.op('@@')(tsquery))
+        relevance = func.ts_rank(vector, tsquery).desc()
+    elif dialect == 'sqlite':
+        query = query.join(questions_fts, questions_fts.c.rowid == Question.id).filter(
+            literal_column('questions_fts').op('MATCH')(fts5_query(term)))
+        # FTS5 rank is the bm25 score where lower values are better matches
+        relevance = questions_fts.c.rank
+    else:
+        query = query.filter(Question.content.ilike(f'%{term}%'))
+        relevance = None
+
+    if rank and relevance is not None:
+        query = query.order_by(None).order_by(
+            relevance, Question.created_at.desc())
+    return query
@@ -0,0 +1,145 @@
+from threading import Lock
+from time import monotonic
+from sqlalchemy import DDL, event, func
+from flask import current_app
+from db import db
+from db.models import Question, User
+
+SNIPPET_LENGTH = 80
+# trigram indexes can not serve shorter terms, they would scan whole tables
+TRIGRAM_MIN_LENGTH = 3
+
+# PostgreSQL: trigram GIN indexes serving "ILIKE '%term%'" lookups. the
+# extension is created before any table since users are created before questions
+event.listen(db.Model.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+event.listen(Question.__table__, 'after_create',
+             DDL('CREATE INDEX ix_questions_content_trgm ON questions USING gin (content gin_trgm_ops)')
+             .execute_if(dialect='postgresql'))
+event.listen(User.__table__, 'after_create',
+             DDL('CREATE INDEX ix_users_username_trgm ON users USING gin (username gin_trgm_ops)')
+             .execute_if(dialect='postgresql'))
+
+class PrefixTrie:
+    '''
+    Prefix trie mapping words prefixes to the keys of the items containing them
+
+    keys are stored on every node along a word path, so a lookup costs
+    O(len(prefix)) regardless of how many words share the prefix
+    '''
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, text: str, key):
+        ''' index every word of text for key '''
+        for word in text.lower().split():
+            node = self.root
+            for char in word:
+                node = node.setdefault(char, {})
+                node.setdefault(None, set()).add(key)
+
+    def lookup(self, prefix: str) -> set:
+        ''' return keys of items with a word starting with prefix '''
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return set()
+        return node.get(None, set())
+
+    def search(self, text: str) -> set:
+        ''' return keys of items matching the prefixes of every word of text '''
+        words = text.lower().split()
+        if not words:
+            return set()
+        keys = self.lookup(words[0])
+        for word in words[1:]:
+            keys = keys & self.lookup(word)
+        return keys
+
+
+class SuggestIndex:
+    '''
+    In-process suggestions index over a bounded hot set of recent questions and users
+
+    used when trigram indexes are not available (not on PostgreSQL, or
+    terms shorter than TRIGRAM_MIN_LENGTH). once the
+    index is older than ttl, one lookup rebuilds it while concurrent lookups
+    keep using the previous one
+    '''
+
+    def __init__(self, size: int, ttl: int):
+        self.size = size
+        self.ttl = ttl
+        self.built_at = None
+        self.lock = Lock()
+        self.questions = PrefixTrie()
+        self.users = PrefixTrie()
+        self.snippets = {}
+
+    def build(self):
+        ''' index the most recent questions and users '''
+        questions, users = PrefixTrie(), PrefixTrie()
+        snippets = {}
+        rows = db.session.query(Question.id, func.substr(Question.content, 1, SNIPPET_LENGTH)).order_by(
+            Question.created_at.desc()).limit(self.size)
+        for id, snippet in rows.all():
+            questions.insert(snippet, id)
+            snippets[id] = snippet
+        rows = db.session.query(User.username).order_by(
+            User.created_at.desc()).limit(self.size)
+        for username, in rows.all():
+            users.insert(username, username)
+        # swap all structures at once, lookups never see a partial index
+        self.questions, self.users, self.snippets = questions, users, snippets
+        self.built_at = monotonic()
+
+    def refresh(self):
+        ''' rebuild the index if it is stale, only one caller rebuilds at a time '''
+        if self.built_at is not None and monotonic() - self.built_at < self.ttl:
+            return
+        if self.lock.acquire(blocking=self.built_at is None):
+            try:
+                self.build()
+            finally:
+                self.lock.release()
+
+    def suggest(self, term: str, limit: int):
+        self.refresh()
+        # higher ids are the most recent questions
+        ids = sorted(self.questions.search(term), reverse=True)[:limit]
+        questions = [{'id': id, 'snippet': self.snippets[id]} for id in ids]
+        usernames = sorted(self.users.search(term))[:limit]
+        return questions, [{'username': username} for username in usernames]
+
+
+def get_suggest_index() -> SuggestIndex:
+    ''' Return the suggestions index of the current app, create it if it does not exist '''
+    if 'suggest_index' not in current_app.extensions:
+        current_app.extensions['suggest_index'] = SuggestIndex(
+            current_app.config['SUGGEST_HOT_SET_SIZE'], current_app.config['SUGGEST_TTL'])
+    return current_app.extensions['suggest_index']
+
+
+def suggest(term: str, limit: int = 5):
+    '''
+    Return (questions, users) suggestions for a term typed by the user
+
+    only ids and short text are loaded. uses trigram indexes on PostgreSQL,
+    otherwise (and for terms too short for them, the common autocomplete
+    case) an in-process prefix trie over a bounded hot set
+    '''
+    if db.engine.dialect.name != 'postgresql' or len(term.strip()) < TRIGRAM_MIN_LENGTH:
+        return get_suggest_index().suggest(term, limit)
+
+    pattern = '%%%s%%' % term.replace('\\', '\\\\').replace(
+        '%', '\\%').replace('_', '\\_')
+    rows = db.session.query(Question.id, func.substr(Question.content, 1, SNIPPET_LENGTH)).filter(
+        Question.content.ilike(pattern)).order_by(
+        func.similarity(Question.content, term).desc()).limit(limit)
+    questions = [{'id': id, 'snippet': snippet} for id, snippet in rows.all()]
+    rows = db.session.query(User.username).filter(User.username.ilike(pattern)).order_by(
+        func.similarity(User.username, term).desc()).limit(limit)
+    users = [{'username': username} for username, in rows.all()]
+    return questions, users
@@ -0,0 +1,193 @@
+import logging
+from uuid import uuid4
+from datetime import datetime, timedelta
+from time import monotonic
+from threading import Thread, Event, Lock
+from flask_mail import Message
+from sqlalchemy import exc, or_, and_
+from db import db
+from db.models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    '''
+    Mail outbox persisted in mail_outbox table
+
+    endpoints only queue messages, a background sender delivers due messages
+    in batches over one SMTP connection, retrying failures with exponential
+    backoff. senders of several workers claim their batches so every message
+    is sent once. with MAIL_DIGEST enabled, pending digestible messages to the same
+    recipient are collapsed into one digest email
+    '''
+
+    def __init__(self, app, mail):
+        self.app = app
+        self.mail = mail
+        self.wakeup = Event()
+        self.thread = None
+        self.lock = Lock()
+        self.purged_at = None
+
+    def queue(self, recipient: str, subject: str, body: str, html: str = None, digest: bool = False):
+        '''
+        persist a message to be sent by the background sender
+
+        the sender is woken up to send it right away, except for digestible
+        messages with MAIL_DIGEST enabled which wait for the next send interval
+        to be collapsed with the messages queued meanwhile
+        '''
+        OutboxMessage(recipient, subject, body, html, digest).insert()
+        if self.app.config['MAIL_OUTBOX_WORKER']:
+            self.start()
+            if not (digest and self.app.config['MAIL_DIGEST']):
+                self.wakeup.set()
+
+    def start(self):
+        ''' start the sender thread if it is not running '''
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(
+                    target=self.run, daemon=True, name='mail-sender')
+                self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.app.config['MAIL_SEND_INTERVAL'])
+            self.wakeup.clear()
+            try:
+                with self.app.app_context():
+                    self.send_pending()
+                    if self.purged_at is None or monotonic() - self.purged_at > 60 * 60:
+                        self.purged_at = monotonic()
+                        self.purge()
+            except Exception:
+                logger.exception('failed to send queued mail')
+
+    def group(self, messages: list) -> list:
+        ''' return a list of (mail message, outbox messages) pairs, collapsing digests if enabled '''
+        groups = []
+        digests = {}
+        for message in messages:
+            if message.digest and self.app.config['MAIL_DIGEST']:
+                digests.setdefault(message.recipient, []).append(message)
+            else:
+                groups.append([message])
+        groups.extend(digests.values())
+
+        pairs = []
+        for group in groups:
+            if len(group) == 1:
+                msg = Message(group[0].subject, recipients=[group[0].recipient],
+                              body=group[0].body, html=group[0].html)
+            else:
+                msg = Message('Sal digest: %i messages' % len(group), recipients=[group[0].recipient],
+                              body='\n\n'.join(m.body for m in group),
+                              html='<hr>'.join(m.html or m.body for m in group))
+            pairs.append((msg, group))
+        return pairs
+
+    def send_pending(self) -> int:
+        '''
+        send a batch of due messages over one SMTP connection
+
+        returns the number of sent outbox messages
+        '''
+        now = datetime.utcnow()
+        messages = self.claim(now)
+        if not messages:
+            return 0
+
+        sent = 0
+        pairs = self.group(messages)
+        try:
+            with self.mail.connect() as conn:
+                for msg, group in pairs:
+                    try:
+                        conn.send(msg)
+                    except Exception:
+                        logger.exception('failed to send mail "%s"', msg.subject)
+                        self.retry(group, now)
+                    else:
+                        for message in group:
+                            message.sent_at = now
+                        sent += len(group)
+        except Exception:
+            # connecting to SMTP server has failed, retry whole batch later
+            logger.exception('failed to connect to mail server')
+            self.retry(messages, now)
+
+        try:
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            db.session.rollback()
+            raise e
+        return sent
+
+    def claim(self, now: datetime) -> list:
+        '''
+        claim a batch of due messages and return them
+
+        claiming postpones messages by MAIL_CLAIM_TIMEOUT in the same conditional
+        update, so concurrent senders never claim the same message and messages
+        of a crashed sender are claimed again once the timeout passes
+        '''
+        config = self.app.config
+        due = and_(OutboxMessage.sent_at.is_(None),
+                   OutboxMessage.next_attempt_at <= now,
+                   OutboxMessage.attempts < config['MAIL_MAX_ATTEMPTS'])
+        ids = [id for (id,) in db.session.query(OutboxMessage.id).filter(due).order_by(
+            OutboxMessage.id).limit(config['MAIL_BATCH_SIZE'])]
+        if not ids:
+            return []
+        claim = uuid4().hex
+        try:
+            OutboxMessage.query.filter(OutboxMessage.id.in_(ids), due).update({
+                OutboxMessage.claimed_by: claim,
+                OutboxMessage.next_attempt_at: now + timedelta(seconds=config['MAIL_CLAIM_TIMEOUT'])
+            }, synchronize_session=False)
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            db.session.rollback()
+            raise e
+        return OutboxMessage.query.filter_by(claimed_by=claim).order_by(OutboxMessage.id).all()
+
+    def purge(self) -> int:
+        '''
+        delete sent messages and messages which ran out of attempts
+        older than MAIL_RETENTION seconds, returns the number of deleted messages
+        '''
+        config = self.app.config
+        cutoff = datetime.utcnow() - timedelta(seconds=config['MAIL_RETENTION'])
+        try:
+            deleted = OutboxMessage.query.filter(or_(
+                OutboxMessage.sent_at < cutoff,
+                and_(OutboxMessage.sent_at.is_(None),
+                     OutboxMessage.attempts >= config['MAIL_MAX_ATTEMPTS'],
+                     OutboxMessage.created_at < cutoff))).delete(synchronize_session=False)
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            db.session.rollback()
+            raise e
+        return deleted
+
+    def retry(self, messages: list, now: datetime):
+        ''' schedule messages for another attempt with exponential backoff '''
+        for message in messages:
+            if message.sent_at is not None:
+                continue
+            message.attempts += 1
+            message.next_attempt_at = now + timedelta(
+                seconds=self.app.config['MAIL_RETRY_BACKOFF'] * 2 ** (message.attempts - 1))
+
+
+def setup_outbox(app, mail):
+    '''
+    setup_outbox(app, mail)
+
+    create the mail outbox of a flask application
+    '''
+    outbox = Outbox(app, mail)
+    app.extensions['outbox'] = outbox
+    return outbox
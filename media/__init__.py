@@ -0,0 +1,190 @@
+import os
+import re
+import hashlib
+import logging
+from os import path
+from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from flask import has_app_context
+from PIL import Image, ImageOps, features
+
+logger = logging.getLogger(__name__)
+
+# image formats by file extension
+formats = {'jpg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'}
+
+
+def is_content_addressed(filename: str) -> bool:
+    ''' Check if filename is named after its content (or its original content for variants) '''
+    return re.match(r'^[0-9a-f]{64}(_[a-z]+)?\.[a-z]+$', filename) is not None
+
+
+def store_stream(stream, storage, ext: str, register=None, chunk_size: int = 64 * 1024) -> tuple:
+    '''
+    Store an uploaded stream under its sha256 digest
+
+    the stream is copied chunk by chunk to a temporary file while being hashed,
+    then saved to storage so partial files are never served. identical
+    content is stored once. register(filename, size) is called before the file
+    is saved, returns (filename, size, whether it was newly stored)
+    '''
+    digest = hashlib.sha256()
+    size = 0
+    with NamedTemporaryFile(dir=storage.temp_dir, delete=False) as f:
+        try:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        except BaseException:
+            os.remove(f.name)
+            raise
+    filename = '%s.%s' % (digest.hexdigest(), ext)
+    try:
+        if register is not None:
+            register(filename, size)
+        if storage.exists(filename):
+            return filename, size, False
+        storage.save(filename, f.name)
+        return filename, size, True
+    finally:
+        if path.isfile(f.name):
+            os.remove(f.name)
+
+
+def file_digest(file, chunk_size: int = 64 * 1024) -> str:
+    ''' Return the sha256 hex digest of a file object '''
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remove_files(storage, filename: str, variants):
+    ''' Remove an uploaded file and its variants '''
+    for variant in variants:
+        for ext in (None, 'webp'):
+            storage.delete(variant_name(filename, variant, ext))
+    storage.delete(filename)
+
+
+def variant_name(filename: str, variant: str, ext: str = None) -> str:
+    ''' Return the file name of a variant of an uploaded image, e.g. "x.jpg" -> "x_small.jpg" '''
+    name, original_ext = filename.rsplit('.', 1)
+    return '%s_%s.%s' % (name, variant, ext or original_ext)
+
+
+def original_name(filename: str, variants) -> str:
+    ''' Return the uploaded image name of a variant file name, None if filename is not a variant '''
+    name, ext = filename.rsplit('.', 1) if '.' in filename else (filename, '')
+    for variant in variants:
+        if name.endswith('_' + variant):
+            return name[:-len(variant) - 1] + '.' + ext
+    return None
+
+
+def image_pixels(file) -> int:
+    '''
+    Return the number of pixels of an image file, None if it can not be read
+
+    only the header is read, so checking it before decoding guards against
+    decompression bombs (small files of huge dimensions). the file is rewound
+    '''
+    try:
+        with Image.open(file) as image:
+            width, height = image.size
+    except (OSError, Image.DecompressionBombError):
+        return None
+    finally:
+        file.seek(0)
+    return width * height
+
+
+def save_image(image, storage, name: str, ext: str):
+    ''' Save an image to storage with web friendly settings '''
+    options = {
+        'jpg': {'quality': 85, 'optimize': True, 'progressive': True},
+        'png': {'optimize': True},
+        'webp': {'quality': 80, 'method': 4}
+    }[ext]
+    with NamedTemporaryFile(dir=storage.temp_dir, delete=False) as f:
+        image.save(f, formats[ext], **options)
+    storage.save(name, f.name)
+
+
+def make_variants(storage, filename: str, sizes: dict, webp: bool = True, max_pixels: int = None):
+    '''
+    Write resized variants of an uploaded image
+
+    every variant fits in a square of its size, it is written in the format
+    of the original and in WebP if webp is true and supported by Pillow.
+    images of more than max_pixels pixels are not decoded
+    '''
+    ext = filename.rsplit('.', 1)[1]
+    with storage.open(filename) as f, Image.open(f) as original:
+        if max_pixels is not None and original.width * original.height > max_pixels:
+            raise ValueError('%s has more than %i pixels' % (filename, max_pixels))
+        original = ImageOps.exif_transpose(original)
+        if ext == 'jpg' and original.mode != 'RGB':
+            original = original.convert('RGB')
+        for variant, size in sizes.items():
+            image = original.copy()
+            image.thumbnail((size, size), Image.LANCZOS)
+            save_image(image, storage, variant_name(filename, variant), ext)
+            if webp and features.check('webp'):
+                save_image(image, storage, variant_name(
+                    filename, variant, 'webp'), 'webp')
+
+
+class ImageProcessor:
+    '''
+    Generate resized variants of uploaded images on a pool of IMAGE_WORKERS
+    threads off the request path (synchronously if it is 0)
+
+    record(filename, webp) is called within an app context once variants
+    are generated, so they can be served without querying storage
+    '''
+
+    def __init__(self, app, storage, record=None):
+        self.app = app
+        self.storage = storage
+        self.record = record
+        self.sizes = app.config['IMAGE_VARIANTS']
+        self.webp = app.config['IMAGE_WEBP']
+        self.max_pixels = app.config['IMAGE_MAX_PIXELS']
+        workers = app.config['IMAGE_WORKERS']
+        self.executor = ThreadPoolExecutor(
+            workers, thread_name_prefix='images') if workers else None
+
+    def process(self, filename: str):
+        ''' generate the variants of an uploaded image '''
+        if self.executor is None:
+            return self.run(filename)
+        self.executor.submit(self.run, filename)
+
+    def run(self, filename: str):
+        try:
+            make_variants(self.storage, filename, self.sizes,
+                          self.webp, self.max_pixels)
+            if self.record is not None:
+                webp = self.webp and features.check('webp')
+                if has_app_context():
+                    # generated synchronously, keep the session of the request
+                    self.record(filename, webp)
+                else:
+                    with self.app.app_context():
+                        self.record(filename, webp)
+        except Exception:
+            # the original is served until variants exist
+            logger.exception('Failed to generate variants of %s', filename)
+
+
+def setup_media(app, storage, record=None):
+    '''
+    setup_media(app, storage, record=None)
+
+    create the image processor of images uploaded to storage
+    '''
+    processor = ImageProcessor(app, storage, record)
+    app.extensions['images'] = processor
+    return processor
@@ -0,0 +1,235 @@
+import os
+import base64
+import mimetypes
+from os import path
+from tempfile import SpooledTemporaryFile
+from flask import current_app, redirect, send_from_directory
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+from werkzeug.utils import import_string
+from compress import send_precompressed
+from media import is_content_addressed
+
+try:
+    # optional S3 compatible storage, enabled by UPLOAD_STORAGE = 's3'
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+
+def shard_path(filename: str) -> str:
+    ''' Return the sharded path of a content addressed file, e.g. "abcdef...jpg" -> "ab/cd/abcdef...jpg" '''
+    return '%s/%s/%s' % (filename[:2], filename[2:4], filename)
+
+
+def guess_mimetype(filename: str) -> str:
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+class LocalStorage:
+    '''
+    Store uploads on the local disk in UPLOAD_FOLDER
+
+    files are stored in shard directories, files uploaded before sharding
+    are found in UPLOAD_FOLDER itself
+    '''
+    supports_presigned_uploads = False
+
+    def __init__(self, app):
+        self.folder = app.config['UPLOAD_FOLDER']
+        # temporary files are created next to stored files so saving is a rename
+        self.temp_dir = self.folder
+
+    def path(self, name: str) -> str:
+        sharded = safe_join(self.folder, shard_path(name))
+        if sharded is not None and path.isfile(sharded):
+            return sharded
+        return safe_join(self.folder, name) or sharded
+
+    def exists(self, name: str) -> bool:
+        file = self.path(name)
+        return file is not None and path.isfile(file)
+
+    def size(self, name: str) -> int:
+        return path.getsize(self.path(name)) if self.exists(name) else None
+
+    def save(self, name: str, source: str):
+        ''' move a local temporary file into storage '''
+        target = path.join(self.folder, shard_path(name))
+        for attempt in range(3):
+            os.makedirs(path.dirname(target), exist_ok=True)
+            try:
+                os.replace(source, target)
+                return
+            except FileNotFoundError:
+                # the shard directory was removed by a concurrent delete
+                if attempt == 2 or not path.isfile(source):
+                    raise
+
+    def open(self, name: str):
+        return open(self.path(name), 'rb')
+
+    def delete(self, name: str):
+        if self.exists(name):
+            file = self.path(name)
+            os.remove(file)
+            # remove emptied shard directories, UPLOAD_FOLDER itself is kept
+            directory = path.dirname(file)
+            for _ in range(2):
+                if path.normpath(directory) == path.normpath(self.folder):
+                    break
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = path.dirname(directory)
+
+    def send(self, name: str):
+        '''
+        Send a stored file
+
+        with UPLOAD_SERVE_MODE "x-accel" or "x-sendfile" the app only emits the
+        header telling the front proxy (nginx or apache/lighttpd) which file to
+        send, otherwise the file is sent by the app with conditional and range
+        requests support (zero-copy where the server provides wsgi.file_wrapper)
+        '''
+        if not self.exists(name):
+            raise NotFound()
+        file = self.path(name)
+        mode = current_app.config['UPLOAD_SERVE_MODE']
+        if mode == 'app':
+            directory = path.dirname(file)
+            return send_precompressed(directory, name) or send_from_directory(directory, name)
+        response = current_app.response_class(mimetype=guess_mimetype(name))
+        if mode == 'x-accel':
+            # path of the file within the internal location of nginx
+            response.headers['X-Accel-Redirect'] = current_app.config['UPLOAD_ACCEL_PREFIX'] + \
+                path.relpath(file, self.folder).replace(os.sep, '/')
+        else:
+            response.headers['X-Sendfile'] = path.abspath(file)
+        return response
+
+
+class S3Storage:
+    '''
+    Store uploads in an S3 compatible bucket (AWS S3, MinIO, ...)
+
+    large files are uploaded in parts, clients download files and can upload
+    them directly from/to the bucket using presigned URLs. URLs are signed
+    with SigV4, which is the only signature covering the checksum and
+    length headers of presigned uploads
+    '''
+    supports_presigned_uploads = True
+
+    def __init__(self, app):
+        if boto3 is None:
+            raise RuntimeError(
+                'UPLOAD_STORAGE is "s3" but boto3 is not installed')
+        self.client = boto3.client('s3', endpoint_url=app.config['S3_ENDPOINT_URL'],
+                                   region_name=app.config['S3_REGION'],
+                                   aws_access_key_id=app.config['S3_ACCESS_KEY_ID'],
+                                   aws_secret_access_key=app.config['S3_SECRET_ACCESS_KEY'],
+                                   config=BotoConfig(signature_version='s3v4'))
+        self.bucket = app.config['S3_BUCKET']
+        self.prefix = app.config['S3_PREFIX']
+        self.public_url = app.config['S3_PUBLIC_URL']
+        self.expires = app.config['S3_URL_EXPIRES']
+        self.cache_control = 'public, max-age=%i, immutable' % app.config['UPLOAD_MAX_AGE']
+        self.transfer = TransferConfig(multipart_threshold=app.config['S3_MULTIPART_THRESHOLD'],
+                                       multipart_chunksize=app.config['S3_MULTIPART_CHUNKSIZE'])
+        # temporary files are created in the default temporary directory
+        self.temp_dir = None
+
+    def key(self, name: str) -> str:
+        return self.prefix + shard_path(name)
+
+    def head(self, name: str) -> dict:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise e
+
+    def exists(self, name: str) -> bool:
+        return self.head(name) is not None
+
+    def size(self, name: str) -> int:
+        head = self.head(name)
+        return head['ContentLength'] if head else None
+
+    def save(self, name: str, source: str):
+        ''' upload a local temporary file (in parts if it is large) then remove it '''
+        try:
+            self.client.upload_file(source, self.bucket, self.key(name), Config=self.transfer, ExtraArgs={
+                'ContentType': guess_mimetype(name), 'CacheControl': self.cache_control})
+        finally:
+            os.remove(source)
+
+    def open(self, name: str):
+        file = SpooledTemporaryFile(max_size=1024 * 1024)
+        self.client.download_fileobj(
+            self.bucket, self.key(name), file, Config=self.transfer)
+        file.seek(0)
+        return file
+
+    def delete(self, name: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def send(self, name: str):
+        '''
+        Redirect to the file in the bucket, bytes never transit the app
+
+        the bucket is not queried, only content addressed names are ever stored
+        '''
+        if not is_content_addressed(name):
+            raise NotFound()
+        if self.public_url:
+            return redirect(self.public_url + self.key(name))
+        return redirect(self.client.generate_presigned_url('get_object', ExpiresIn=self.expires, Params={
+            'Bucket': self.bucket, 'Key': self.key(name)}))
+
+    def presign_upload(self, name: str, size: int, sha256: str) -> dict:
+        '''
+        Return the request a client has to send to upload a file directly
+
+        the bucket rejects content whose sha256 or length do not match the
+        signed ones, services ignoring checksums are covered by verifying
+        the content once the upload completes
+        '''
+        checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+        headers = {
+            'Content-Type': guess_mimetype(name),
+            'Cache-Control': self.cache_control,
+            'x-amz-checksum-sha256': checksum
+        }
+        url = self.client.generate_presigned_url('put_object', ExpiresIn=self.expires, Params={
+            'Bucket': self.bucket, 'Key': self.key(name), 'ContentLength': size,
+            'ContentType': headers['Content-Type'], 'CacheControl': headers['Cache-Control'],
+            'ChecksumSHA256': checksum})
+        return {'method': 'PUT', 'url': url, 'headers': headers}
+
+
+backends = {
+    'local': LocalStorage,
+    's3': S3Storage
+}
+
+
+def setup_storage(app):
+    '''
+    setup_storage(app)
+
+    create the uploads storage configured by UPLOAD_STORAGE, which is either
+    a name of a built-in backend or an import path of a class implementing
+    the LocalStorage interface (and presign_upload of S3Storage if it
+    supports presigned uploads)
+    '''
+    backend = app.config['UPLOAD_STORAGE']
+    storage_class = backends.get(backend) or import_string(backend)
+    storage = storage_class(app)
+    app.extensions['storage'] = storage
+    return storage
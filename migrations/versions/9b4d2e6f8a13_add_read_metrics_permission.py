@@ -0,0 +1,40 @@
+"""Add read:metrics permission
+
+Revision ID: 9b4d2e6f8a13
+Revises: 5e7b9c3d1a28
+Create Date: 2026-10-17 21:03:52.418306
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9b4d2e6f8a13'
+down_revision = '5e7b9c3d1a28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # databases seeded before the permission existed, grant it to superadmin
+    op.execute('''
+        INSERT INTO permissions (name)
+        SELECT 'read:metrics'
+        WHERE NOT EXISTS (SELECT 1 FROM permissions WHERE name = 'read:metrics')
+    ''')
+    op.execute('''
+        INSERT INTO roles_permissions (role_id, permission_id)
+        SELECT roles.id, permissions.id FROM roles, permissions
+        WHERE roles.name = 'superadmin' AND permissions.name = 'read:metrics'
+        AND NOT EXISTS (SELECT 1 FROM roles_permissions
+                        WHERE roles_permissions.role_id = roles.id
+                        AND roles_permissions.permission_id = permissions.id)
+    ''')
+
+
+def downgrade():
+    op.execute('''
+        DELETE FROM roles_permissions WHERE permission_id IN
+        (SELECT id FROM permissions WHERE name = 'read:metrics')
+    ''')
+    op.execute("DELETE FROM permissions WHERE name = 'read:metrics'")
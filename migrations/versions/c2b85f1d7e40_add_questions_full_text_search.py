@@ -0,0 +1,53 @@
+"""Add questions full text search
+
+Revision ID: c2b85f1d7e40
+Revises: a4d7e0c35b18
+Create Date: 2026-10-17 12:21:09.417352
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2b85f1d7e40'
+down_revision = 'a4d7e0c35b18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        # tsvector column maintained by postgres on every write
+        op.execute("ALTER TABLE questions ADD COLUMN search_vector tsvector "
+                   "GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED")
+        op.create_index('ix_questions_search_vector', 'questions',
+                        ['search_vector'], postgresql_using='gin')
+    elif dialect == 'sqlite':
+        # external content FTS5 table kept in sync by triggers
+        op.execute("CREATE VIRTUAL TABLE questions_fts USING fts5"
+                   "(content, content='questions', content_rowid='id')")
+        op.execute("CREATE TRIGGER questions_fts_insert AFTER INSERT ON questions BEGIN "
+                   "INSERT INTO questions_fts(rowid, content) VALUES (new.id, new.content); END")
+        op.execute("CREATE TRIGGER questions_fts_delete AFTER DELETE ON questions BEGIN "
+                   "INSERT INTO questions_fts(questions_fts, rowid, content) "
+                   "VALUES ('delete', old.id, old.content); END")
+        op.execute("CREATE TRIGGER questions_fts_update AFTER UPDATE OF content ON questions BEGIN "
+                   "INSERT INTO questions_fts(questions_fts, rowid, content) "
+                   "VALUES ('delete', old.id, old.content); "
+                   "INSERT INTO questions_fts(rowid, content) VALUES (new.id, new.content); END")
+        # index existing questions
+        op.execute("INSERT INTO questions_fts(questions_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.drop_index('ix_questions_search_vector', table_name='questions')
+        op.drop_column('questions', 'search_vector')
+    elif dialect == 'sqlite':
+        op.execute('DROP TRIGGER IF EXISTS questions_fts_update')
+        op.execute('DROP TRIGGER IF EXISTS questions_fts_delete')
+        op.execute('DROP TRIGGER IF EXISTS questions_fts_insert')
+        op.execute('DROP TABLE IF EXISTS questions_fts')
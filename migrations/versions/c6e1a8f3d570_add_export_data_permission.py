@@ -0,0 +1,40 @@
+"""Add export:data permission
+
+Revision ID: c6e1a8f3d570
+Revises: 9b4d2e6f8a13
+Create Date: 2026-10-17 21:09:27.630914
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6e1a8f3d570'
+down_revision = '9b4d2e6f8a13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # databases seeded before the permission existed, grant it to superadmin
+    op.execute('''
+        INSERT INTO permissions (name)
+        SELECT 'export:data'
+        WHERE NOT EXISTS (SELECT 1 FROM permissions WHERE name = 'export:data')
+    ''')
+    op.execute('''
+        INSERT INTO roles_permissions (role_id, permission_id)
+        SELECT roles.id, permissions.id FROM roles, permissions
+        WHERE roles.name = 'superadmin' AND permissions.name = 'export:data'
+        AND NOT EXISTS (SELECT 1 FROM roles_permissions
+                        WHERE roles_permissions.role_id = roles.id
+                        AND roles_permissions.permission_id = permissions.id)
+    ''')
+
+
+def downgrade():
+    op.execute('''
+        DELETE FROM roles_permissions WHERE permission_id IN
+        (SELECT id FROM permissions WHERE name = 'export:data')
+    ''')
+    op.execute("DELETE FROM permissions WHERE name = 'export:data'")
@@ -0,0 +1,34 @@
+"""Add trigram indexes
+
+Revision ID: d93a6b27f0c1
+Revises: c2b85f1d7e40
+Create Date: 2026-10-17 13:02:55.730814
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd93a6b27f0c1'
+down_revision = 'c2b85f1d7e40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # trigram indexes are postgres only, other databases use the in-process index
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_questions_content_trgm', 'questions', ['content'],
+                    postgresql_using='gin', postgresql_ops={'content': 'gin_trgm_ops'})
+    op.create_index('ix_users_username_trgm', 'users', ['username'],
+                    postgresql_using='gin', postgresql_ops={'username': 'gin_trgm_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_users_username_trgm', table_name='users')
+    op.drop_index('ix_questions_content_trgm', table_name='questions')
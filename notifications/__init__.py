@@ -0,0 +1,124 @@
+import atexit
+import logging
+from queue import Queue, Empty
+from threading import Thread, Lock
+from time import monotonic
+from werkzeug.utils import import_string
+from sqlalchemy import exc
+from db import db
+from db.models import Notification
+
+logger = logging.getLogger(__name__)
+
+
+def insert_notifications(notifications: list):
+    '''
+    Insert many notifications with a single executemany statement
+
+    identical notifications (same user, content and url) are coalesced into one
+    '''
+    rows = list({(n['user_id'], n['content'], n['url']): n
+                 for n in notifications}.values())
+    try:
+        db.session.execute(Notification.__table__.insert(), rows)
+        db.session.commit()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        raise e
+
+
+class SyncNotifier:
+    ''' Insert notifications on the request path (used in tests) '''
+
+    def __init__(self, app):
+        self.app = app
+
+    def notify(self, user_id: int, content: str, url: str):
+        insert_notifications(
+            [{'user_id': user_id, 'content': content, 'url': url}])
+
+    def flush(self):
+        pass
+
+
+class ThreadNotifier:
+    '''
+    Insert notifications from a background thread off the request path
+
+    notifications are queued and inserted in batches of at most
+    NOTIFICATIONS_BATCH_SIZE, waiting at most NOTIFICATIONS_BATCH_INTERVAL
+    seconds for a batch to fill up
+    '''
+
+    def __init__(self, app):
+        self.app = app
+        self.batch_size = app.config['NOTIFICATIONS_BATCH_SIZE']
+        self.interval = app.config['NOTIFICATIONS_BATCH_INTERVAL']
+        self.queue = Queue()
+        self.thread = None
+        self.lock = Lock()
+
+    def notify(self, user_id: int, content: str, url: str):
+        self.start()
+        self.queue.put({'user_id': user_id, 'content': content, 'url': url})
+
+    def start(self):
+        ''' start the worker thread if it is not running '''
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True,
+                                     name='notifications-worker')
+                self.thread.start()
+                # insert queued notifications before the process exits
+                atexit.register(self.flush)
+
+    def flush(self):
+        ''' block until all queued notifications are inserted '''
+        self.queue.join()
+
+    def next_batch(self) -> list:
+        ''' wait for a notification then collect more until the batch is full or interval elapses '''
+        batch = [self.queue.get()]
+        deadline = monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                with self.app.app_context():
+                    insert_notifications(batch)
+            except Exception:
+                logger.exception('failed to insert %i notifications', len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+backends = {
+    'sync': SyncNotifier,
+    'thread': ThreadNotifier
+}
+
+
+def setup_notifications(app):
+    '''
+    setup_notifications(app)
+
+    create the notifier configured by NOTIFICATIONS_BACKEND, which is either
+    a name of a built-in backend or an import path of a class implementing
+    notify(user_id, content, url) and flush() (e.g. to use a local broker)
+    '''
+    backend = app.config['NOTIFICATIONS_BACKEND']
+    notifier_class = backends.get(backend) or import_string(backend)
+    notifier = notifier_class(app)
+    app.extensions['notifier'] = notifier
+    return notifier
@@ -0,0 +1,60 @@
+from datetime import datetime
+from flask.json import JSONEncoder
+
+try:
+    # optional faster JSON backend, used when installed
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StdlibEncoder(JSONEncoder):
+    '''
+    Flask JSON encoder writing datetimes as http dates
+    or as ISO 8601 strings if datetime_format is "iso"
+    '''
+    datetime_format = 'http'
+
+    def default(self, o):
+        if isinstance(o, datetime) and self.datetime_format == 'iso':
+            # naive datetimes are in UTC
+            return o.isoformat() if o.tzinfo else o.isoformat() + '+00:00'
+        return super().default(o)
+
+
+class OrjsonEncoder(StdlibEncoder):
+    '''
+    Flask JSON encoder encoding with orjson
+
+    values orjson can not encode fall back to the stdlib encoder
+    '''
+
+    def encode(self, o) -> str:
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if self.indent:
+            option |= orjson.OPT_INDENT_2
+        if self.datetime_format == 'iso':
+            option |= orjson.OPT_NAIVE_UTC
+        else:
+            # let default write datetimes as http dates
+            option |= orjson.OPT_PASSTHROUGH_DATETIME
+        try:
+            return orjson.dumps(o, default=self.default, option=option).decode()
+        except TypeError:
+            return super().encode(o)
+
+
+def setup_json(app):
+    '''
+    setup_json(app)
+
+    encode responses with the JSON_BACKEND encoder, "orjson" falls back
+    to "stdlib" if orjson is not installed
+    '''
+    encoder = StdlibEncoder
+    if app.config['JSON_BACKEND'] == 'orjson' and orjson is not None:
+        encoder = OrjsonEncoder
+    app.json_encoder = type(encoder.__name__, (encoder,), {
+        'datetime_format': app.config['JSON_DATETIME_FORMAT']})
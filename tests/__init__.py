@@ -1,10 +1,30 @@
+import os
+import gzip
+import hashlib
 import unittest
-from auth import generate_token
+from datetime import datetime, timedelta
+from threading import Thread
+from auth import generate_token, get_token_cache, decode_token
 from app import create_app
-from db.models import Question, Answer, User, Role, Notification
+from db.models import Question, Answer, User, Role, Permission, Notification, StoredFile, Upload, reconcile_counters, roles_permissions
 from config import TestingConfig
 from io import BytesIO
 from db import db
+from notifications import ThreadNotifier
+from auth.passwords import PasswordHasher
+from serialization import StdlibEncoder, OrjsonEncoder
+from flask import json
+from sqlalchemy import event
+from PIL import Image
+from media import variant_name, remove_files
+from cache.responses import ResponseCache, RedisCache
+
+try:
+    # optional S3 storage is tested against a mocked bucket
+    from moto import mock_s3
+    import requests
+except ImportError:
+    mock_s3 = None
 
 
 class SalTestCase(unittest.TestCase):
@@ -14,6 +34,10 @@ class SalTestCase(unittest.TestCase):
         ''' Executes before each test. Inti the app and define test variables '''
         self.app = create_app(TestingConfig)
         self.client = self.app.test_client
+        # push an application context as generate_token function and models need it
+        # ref: https://flask.palletsprojects.com/en/2.0.x/appcontext/#lifetime-of-the-context
+        self.ctx = self.app.app_context()
+        self.ctx.push()
         # seed data
         self.role = Role('general')
         self.role.insert()
@@ -27,15 +51,13 @@ class SalTestCase(unittest.TestCase):
         self.notification = Notification(self.user.id, 'test', '/test')
         self.notification.insert()
         # generate token
-        # push an application context as generate_token function needs it
-        # ref: https://flask.palletsprojects.com/en/2.0.x/appcontext/#lifetime-of-the-context
-        self.app.app_context().push()
         self.token = generate_token('ahmedhrayyan')
 
     def tearDown(self):
         ''' Executes after each test '''
         db.session.remove()
         db.drop_all()
+        self.ctx.pop()
 
     def test_422_upload(self):
         res = self.client().post('api/upload',
@@ -47,6 +69,183 @@ class SalTestCase(unittest.TestCase):
         self.assertFalse(json_data['success'])
         self.assertTrue(json_data['message'])
 
+    def upload_image(self):
+        image = BytesIO()
+        Image.new('RGB', (800, 600), 'red').save(image, 'PNG')
+        data = image.getvalue()
+        res = self.client().post('api/upload',
+                                 headers={
+                                     'Authorization': 'Bearer %s' % self.token},
+                                 data={'file': (BytesIO(data), 'file.png')})
+        self.assertEqual(res.status_code, 200)
+        filename = res.get_json()['path']
+        self.addCleanup(self.remove_upload, filename)
+        self.assertEqual(filename, hashlib.sha256(data).hexdigest() + '.png')
+        self.assertEqual(res.get_json()['sha256'], hashlib.sha256(data).hexdigest())
+        return filename
+
+    def remove_upload(self, filename):
+        remove_files(self.app.extensions['storage'],
+                     filename, self.app.config['IMAGE_VARIANTS'])
+
+    def test_upload(self):
+        filename = self.upload_image()
+        # identical content is stored once
+        self.assertEqual(self.upload_image(), filename)
+        # resized variants are served in place of the original
+        res = self.client().get('/uploads/%s' % variant_name(filename, 'small'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Image.open(BytesIO(res.data)).size, (96, 72))
+        self.assertTrue(res.cache_control.immutable)
+        res.close()
+
+    def test_422_upload_too_many_pixels(self):
+        self.app.config['IMAGE_MAX_PIXELS'] = 100
+        image = BytesIO()
+        Image.new('RGB', (20, 20), 'red').save(image, 'PNG')
+        res = self.client().post('api/upload',
+                                 headers={
+                                     'Authorization': 'Bearer %s' % self.token},
+                                 data={'file': (BytesIO(image.getvalue()), 'file.png')})
+        self.assertEqual(res.status_code, 422)
+
+    def test_view_uploaded_range(self):
+        filename = self.upload_image()
+        res = self.client().get('/uploads/%s' % filename,
+                                headers={'Range': 'bytes=0-9'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(len(res.data), 10)
+        res.close()
+        # let the front proxy send the file
+        self.app.config['UPLOAD_SERVE_MODE'] = 'x-accel'
+        res = self.client().get('/uploads/%s' % filename)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['X-Accel-Redirect'], '/protected-uploads/%s/%s/%s' % (
+            filename[:2], filename[2:4], filename))
+        self.assertEqual(res.data, b'')
+
+    @unittest.skipIf(mock_s3 is None, 'moto is not installed')
+    def test_s3_presigned_upload(self):
+        class S3Config(TestingConfig):
+            UPLOAD_STORAGE = 's3'
+            S3_BUCKET = 'sal'
+            S3_REGION = 'us-east-1'
+            S3_ACCESS_KEY_ID = 'testing'
+            S3_SECRET_ACCESS_KEY = 'testing'
+        image = BytesIO()
+        Image.new('RGB', (800, 600), 'red').save(image, 'PNG')
+        data = image.getvalue()
+        sha256 = hashlib.sha256(data).hexdigest()
+        headers = {'Authorization': 'Bearer %s' % self.token}
+        with mock_s3():
+            app = create_app(S3Config)
+            storage = app.extensions['storage']
+            storage.client.create_bucket(Bucket='sal')
+            for content, status in ((b'\x89PNG\r\n\x1a\n' + bytes(len(data) - 8), 422), (data, 200)):
+                res = app.test_client().post('/api/uploads/presign', headers=headers,
+                                             json={'sha256': sha256, 'size': len(data), 'ext': 'png'})
+                self.assertEqual(res.status_code, 200)
+                upload = res.get_json()['upload']
+                # the checksum and the length are signed
+                self.assertIn('X-Amz-Algorithm=AWS4-HMAC-SHA256', upload['url'])
+                self.assertIn('content-length%3Bcontent-type%3Bhost%3Bx-amz-checksum-sha256',
+                              upload['url'])
+                # the client sends the file to the bucket
+                self.assertEqual(requests.put(upload['url'], data=content,
+                                              headers=upload['headers']).status_code, 200)
+                # content not matching its name is rejected even if the bucket took it
+                res = app.test_client().post('/api/uploads/complete', headers=headers,
+                                             json={'path': sha256 + '.png'})
+                self.assertEqual(res.status_code, status)
+            self.assertTrue(storage.exists(variant_name(sha256 + '.png', 'small')))
+            # files are downloaded from the bucket
+            res = app.test_client().get('/uploads/%s' % variant_name(sha256 + '.png', 'small'))
+            self.assertEqual(res.status_code, 302)
+            self.assertIn(storage.key(variant_name(sha256 + '.png', 'small')),
+                          res.headers['Location'])
+
+    def test_400_complete_upload_local(self):
+        filename = self.upload_image()
+        res = self.client().post('/api/uploads/complete',
+                                 headers={'Authorization': 'Bearer %s' % self.token},
+                                 json={'path': filename})
+        self.assertEqual(res.status_code, 400)
+
+    def test_gc_uploads(self):
+        filename = self.upload_image()
+        res = self.client().patch('/api/profile',
+                                  headers={
+                                      'Authorization': 'Bearer %s' % self.token},
+                                  json={'avatar': filename})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(StoredFile.query.get(filename).refs, 1)
+        # referenced files are kept
+        self.assertEqual(StoredFile.collect(-1), [])
+        self.user.avatar = None
+        StoredFile.release(filename)
+        self.user.update()
+        removed = []
+        self.assertEqual(StoredFile.collect(-1, removed.append), [filename])
+        self.assertEqual(removed, [filename])
+        self.assertIsNone(StoredFile.query.get(filename))
+        # removed files are not listed, counted nor usable anymore
+        self.assertFalse(Upload.owns(self.user.id, filename))
+        self.assertEqual(Upload.usage(self.user.id), 0)
+        res = self.client().patch('/api/profile',
+                                  headers={
+                                      'Authorization': 'Bearer %s' % self.token},
+                                  json={'avatar': filename})
+        self.assertEqual(res.status_code, 422)
+
+    def test_patch_profile_avatar_unstored(self):
+        headers = {'Authorization': 'Bearer %s' % self.token}
+        # registered uploads whose content is not stored are rejected
+        filename = 'a' * 64 + '.png'
+        Upload(self.user.id, filename, 1, 'image/png').insert()
+        res = self.client().patch('/api/profile', headers=headers,
+                                  json={'avatar': filename})
+        self.assertEqual(res.status_code, 422)
+        # files uploaded before content addressing are not reference counted
+        Upload(self.user.id, 'legacy.png', 1, 'image/png').insert()
+        res = self.client().patch('/api/profile', headers=headers,
+                                  json={'avatar': 'legacy.png'})
+        self.assertEqual(res.status_code, 200)
+
+    def test_get_uploads(self):
+        filename = self.upload_image()
+        res = self.client().get('/api/uploads',
+                                headers={'Authorization': 'Bearer %s' % self.token})
+        json_data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([upload['path'] for upload in json_data['data']], [filename])
+        self.assertEqual(json_data['meta']['used'], json_data['data'][0]['size'])
+
+    def test_422_upload_quota(self):
+        self.app.config['UPLOAD_QUOTA'] = 0
+        image = BytesIO()
+        Image.new('RGB', (8, 8), 'red').save(image, 'PNG')
+        data = image.getvalue()
+        res = self.client().post('api/upload',
+                                 headers={
+                                     'Authorization': 'Bearer %s' % self.token},
+                                 data={'file': (BytesIO(data), 'file.png')})
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.get_json()['message'], 'Upload quota exceeded')
+        # files over quota are not stored
+        self.assertFalse(self.app.extensions['storage'].exists(
+            hashlib.sha256(data).hexdigest() + '.png'))
+
+    def test_422_patch_profile_avatar(self):
+        # files uploaded by others can not be used
+        filename = self.upload_image()
+        token = generate_token('other')
+        User('Other', 'User', 'other@test.com', 'other',
+             'secret', self.role.id).insert()
+        res = self.client().patch('/api/profile',
+                                  headers={'Authorization': 'Bearer %s' % token},
+                                  json={'avatar': filename})
+        self.assertEqual(res.status_code, 422)
+
     def test_404_view_uploaded(self):
         res = self.client().get('/uploads/x')
         self.assertEqual(res.status_code, 404)
@@ -111,6 +310,65 @@ class SalTestCase(unittest.TestCase):
         self.assertTrue(res_data['success'])
         self.assertIsInstance(res_data['token'], str)
 
+    def test_login_token_claims(self):
+        self.assertEqual(Role.get_permissions(self.role.id), [])
+        # changing role permissions invalidates the cache
+        self.role.permissions.append(Permission('delete:answers'))
+        self.role.update()
+        res = self.client().post('/api/login',
+                                 json={
+                                     'username': 'ahmedhrayyan',
+                                     'password': 'secret'
+                                 })
+        payload = decode_token(res.get_json()['token'])
+        self.assertEqual(payload['uid'], self.user.id)
+        self.assertEqual(payload['role'], self.role.id)
+        self.assertEqual(payload['permissions'], ['delete:answers'])
+
+    def test_setup_auth_backend(self):
+        class BadConfig(TestingConfig):
+            JWT_BACKEND = 'unknown'
+        with self.assertRaises(RuntimeError):
+            create_app(BadConfig)
+
+    def test_roles_cache_ttl(self):
+        permission = Permission('delete:answers')
+        permission.insert()
+        self.assertEqual(Role.get_permissions(self.role.id), [])
+        # changes made by other processes do not invalidate the cache
+        db.session.execute(roles_permissions.insert().values(
+            role_id=self.role.id, permission_id=permission.id))
+        db.session.commit()
+        self.assertEqual(Role.get_permissions(self.role.id), [])
+        # until it expires
+        self.app.config['ROLES_CACHE_TTL'] = 0
+        self.assertEqual(Role.get_permissions(self.role.id), ['delete:answers'])
+
+    def test_login_rehash_password(self):
+        self.app.extensions['password_hasher'].rounds = 5
+        res = self.client().post('/api/login',
+                                 json={
+                                     'username': 'ahmedhrayyan',
+                                     'password': 'secret'
+                                 })
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(self.user.needs_rehash())
+        self.assertTrue(self.user.checkpw('secret'))
+
+    def test_503_login_hasher_busy(self):
+        hasher = PasswordHasher(4, 1, 0)
+        self.app.extensions['password_hasher'] = hasher
+        hasher.slots.acquire()
+        res = self.client().post('/api/login',
+                                 json={
+                                     'username': 'ahmedhrayyan',
+                                     'password': 'secret'
+                                 })
+        hasher.slots.release()
+        res_data = res.get_json()
+        self.assertEqual(res.status_code, 503)
+        self.assertFalse(res_data['success'])
+
     def test_401_get_profile(self):
         res = self.client().get('/api/profile')
         res_data = res.get_json()
@@ -125,6 +383,44 @@ class SalTestCase(unittest.TestCase):
         self.assertTrue(res_data['success'])
         self.assertEqual(res_data['data']['username'], self.user.username)
 
+    def test_get_profile_by_token_user_id(self):
+        token = generate_token(self.user.username, user_id=self.user.id)
+        res = self.client().get('/api/profile',
+                                headers={'Authorization': 'Bearer %s' % token})
+        res_data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res_data['data']['id'], self.user.id)
+
+    def test_get_questions_viewer_by_token_user_id(self):
+        token = generate_token(self.user.username, user_id=self.user.id)
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        # the user would be found in the identity map without querying
+        db.session.expunge_all()
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            res = self.client().get('/api/questions',
+                                    headers={'Authorization': 'Bearer %s' % token})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('viewer_vote', res.get_json()['data'][0])
+        # users are only queried for the authors, not for the viewer
+        self.assertEqual(len([s for s in statements if 'FROM users' in s]), 1)
+
+    def test_cache_verified_token(self):
+        cache = get_token_cache()
+        self.assertIsNone(cache.get(self.token))
+        res = self.client().get('/api/profile',
+                                headers={'Authorization': 'Bearer %s' % self.token})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(cache.get(self.token)['sub'], self.user.username)
+        # expired payloads are evicted
+        cache.set('expired', {'sub': 'x', 'exp': 0})
+        self.assertIsNone(cache.get('expired'))
+
     def test_get_notifications(self):
         res = self.client().get('/api/notifications',
                                 headers={'Authorization': 'Bearer %s' % self.token})
@@ -139,6 +435,142 @@ class SalTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(json_data['success'])
 
+    def test_get_questions_cache(self):
+        res = self.client().get('/api/questions')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        res = self.client().get('/api/questions')
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        self.assertEqual(len(res.get_json()['data']), 1)
+        # writes invalidate cached pages
+        self.client().post('/api/questions',
+                           headers={'Authorization': 'Bearer %s' % self.token},
+                           json={'content': 'Is this great or what'})
+        res = self.client().get('/api/questions')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(res.get_json()['data']), 2)
+        self.assertEqual(self.app.extensions['response_cache'].stats(),
+                         {'hits': 1, 'misses': 2})
+
+    def test_shared_response_cache_invalidation(self):
+        class Client(dict):
+            ''' in memory stand in for the few redis commands used '''
+
+            def set(self, key, value, ex=None):
+                self[key] = value
+
+            def incr(self, key):
+                self[key] = int(self.get(key) or 0) + 1
+
+        backend = RedisCache.__new__(RedisCache)
+        backend.client, backend.ttl, backend.prefix = Client(), 30, 'sal:responses:'
+        cache = ResponseCache(self.app, backend)
+
+        def compute():
+            # another process writes and invalidates while this page is computed
+            backend.clear()
+            return b'stale'
+        self.assertEqual(cache.fetch('/api/questions', compute), (b'stale', False))
+        # the stale page is not served
+        self.assertEqual(cache.fetch('/api/questions', lambda: b'fresh'), (b'fresh', False))
+        self.assertEqual(cache.fetch('/api/questions', lambda: None), (b'fresh', True))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2})
+
+    def test_json_encoders(self):
+        data = {'data': Question.format_many([self.question])}
+        self.assertEqual(json.loads(json.dumps(data, cls=OrjsonEncoder)),
+                         json.loads(json.dumps(data, cls=StdlibEncoder)))
+        # datetimes are http dates by default
+        self.assertEqual(json.loads(self.client().get('/api/questions').data)['data'][0]['created_at'],
+                         json.loads(json.dumps(self.question.created_at, cls=StdlibEncoder)))
+
+    def test_get_questions_compressed(self):
+        for i in range(10):
+            Question(self.user.id, 'question number %i ' % i * 10).insert()
+        res = self.client().get('/api/questions',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(res.data))['data']), 11)
+        # small responses are sent as is
+        res = self.client().get('/api/questions/%i' % self.question.id,
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+
+    def test_get_questions_tallies(self):
+        self.question.vote(self.user.id, True)
+        Question(self.user.id, 'not voted').insert()
+        res = self.client().get('/api/questions',
+                                headers={'Authorization': 'Bearer %s' % self.token})
+        json_data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        questions = {q['id']: q for q in json_data['data']}
+        self.assertEqual(questions[self.question.id]['upvotes'], 1)
+        self.assertEqual(questions[self.question.id]['answers_count'], 1)
+        self.assertEqual(questions[self.question.id]['viewer_vote'], True)
+        self.assertEqual(
+            questions[self.question.id]['user']['questions_count'], 2)
+        self.assertEqual(len(questions), 2)
+
+    def test_search_questions(self):
+        Question(self.user.id, 'which engine is the best, best one').insert()
+        Question(self.user.id, 'unrelated question').insert()
+        res = self.client().get('/api/questions?searchTerm=best&orderBy=relevance')
+        json_data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json_data['meta']['total'], 2)
+        self.assertIn('best one', json_data['data'][0]['content'])
+
+    def test_paginate_questions(self):
+        for i in range(3):
+            Question(self.user.id, 'question %i' % i).insert()
+        res = self.client().get('/api/questions?page=2')
+        json_data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json_data['meta']['total'], 4)
+        self.assertEqual(json_data['meta']['current_page'], 2)
+        self.assertEqual(len(json_data['data']), 0)
+
+    def test_cursor_paginate_question_answers(self):
+        for i in range(4):
+            Answer(self.user.id, self.question.id, 'answer %i' % i).insert()
+        res = self.client().get('/api/questions/%i/answers?cursor=' %
+                                self.question.id)
+        json_data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(json_data['data']), 4)
+        first_page_ids = [answer['id'] for answer in json_data['data']]
+        res = self.client().get('/api/questions/%i/answers?cursor=%s' %
+                                (self.question.id, json_data['meta']['next_cursor']))
+        json_data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(json_data['data']), 1)
+        self.assertNotIn(json_data['data'][0]['id'], first_page_ids)
+        self.assertIsNone(json_data['meta']['next_cursor'])
+
+    def test_400_cursor_paginate_questions(self):
+        res = self.client().get('/api/questions?cursor=invalid')
+        json_data = res.get_json()
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(json_data['success'])
+
+    def test_suggest(self):
+        res = self.client().get('/api/suggest?q=sal be')
+        json_data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json_data['data']['questions'][0]['id'],
+                         self.question.id)
+        res = self.client().get('/api/suggest?q=ahmed')
+        json_data = res.get_json()
+        self.assertEqual(json_data['data']['users'][0]['username'],
+                         self.user.username)
+        self.assertEqual(json_data['data']['questions'], [])
+
+    def test_400_suggest(self):
+        res = self.client().get('/api/suggest')
+        json_data = res.get_json()
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(json_data['success'])
+
     def test_404_show_question(self):
         res = self.client().get('/api/questions/232482')
         json_data = res.get_json()
@@ -153,6 +585,27 @@ class SalTestCase(unittest.TestCase):
         self.assertTrue(json_data['success'])
         self.assertEqual(self.question.id, json_data['data']['id'])
 
+    def test_show_question_not_modified(self):
+        res = self.client().get('/api/questions/%i' % self.question.id)
+        etag = res.headers['ETag']
+        self.assertIn('public', res.headers['Cache-Control'])
+        self.assertIn('Authorization', res.headers['Vary'])
+        res = self.client().get('/api/questions/%i' % self.question.id,
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        # votes bump the question version
+        self.question.vote(self.user.id, True)
+        res = self.client().get('/api/questions/%i' % self.question.id,
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        # viewers get their own private copy
+        res = self.client().get('/api/questions/%i' % self.question.id,
+                                headers={'If-None-Match': res.headers['ETag'],
+                                         'Authorization': 'Bearer %s' % self.token})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('private', res.headers['Cache-Control'])
+
     def test_get_question_answers(self):
         res = self.client().get('/api/questions/%i/answers' % self.question.id)
         json_data = res.get_json()
@@ -217,6 +670,31 @@ class SalTestCase(unittest.TestCase):
         self.assertTrue(json_data['success'])
         self.assertEqual(json_data['data']['viewer_vote'], None)
 
+    def test_upsert_vote_answer(self):
+        self.assertEqual(self.answer.vote(self.user.id, True), (1, 0))
+        # voting again with the same vote changes nothing
+        self.assertEqual(self.answer.vote(self.user.id, True), (1, 0))
+        self.assertEqual(self.answer.vote(self.user.id, False), (0, 1))
+        self.assertEqual(self.answer.unvote(self.user.id), (0, 0))
+        self.assertEqual(self.answer.unvote(self.user.id), (0, 0))
+
+    def test_vote_question_counters(self):
+        self.question.vote(self.user.id, True)
+        self.question.vote(self.user.id, False)
+        self.assertEqual(self.question.upvotes, 0)
+        self.assertEqual(self.question.downvotes, 1)
+        self.question.unvote(self.user.id)
+        self.assertEqual(self.question.downvotes, 0)
+
+    def test_reconcile_counters(self):
+        self.question.upvotes = 10
+        self.user.answers_count = 0
+        self.question.update()
+        self.assertEqual(reconcile_counters(), 2)
+        self.assertEqual(self.question.upvotes, 0)
+        self.assertEqual(self.user.answers_count, 1)
+        self.assertEqual(reconcile_counters(), 0)
+
     def test_404_delete_question(self):
         res = self.client().delete('/api/questions/10000',
                                    headers={'Authorization': 'Bearer %s' % self.token})
@@ -232,6 +710,9 @@ class SalTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(json_data['success'])
         self.assertEqual(self.question.id, json_data['deleted_id'])
+        # the deleted question and its answers are discounted from the author
+        self.assertEqual(self.user.questions_count, 0)
+        self.assertEqual(self.user.answers_count, 0)
 
     def test_404_show_answer(self):
         res = self.client().get('/api/answers/10420')
@@ -339,6 +820,21 @@ class SalTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(json_data['success'])
 
+    def test_thread_notifier(self):
+        notifier = ThreadNotifier(self.app)
+        # repeated votes on the same target are coalesced
+        for _ in range(3):
+            notifier.notify(self.user.id, 'new upvote', '/questions/1')
+        notifier.notify(self.user.id, 'new answer', '/questions/1')
+        notifier.flush()
+        self.assertEqual(self.user.notifications.count(), 3)
+
+    def test_vote_question_notification(self):
+        self.client().post('/api/questions/%i/vote' % self.question.id,
+                           headers={'Authorization': 'Bearer %s' % self.token},
+                           json={'vote': 1})
+        self.assertEqual(self.user.notifications.count(), 2)
+
     def test_404_show_user(self):
         res = self.client().get('/api/users/x')
         json_data = res.get_json()
@@ -366,6 +862,70 @@ class SalTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(json_data['success'])
 
+    def test_show_metrics(self):
+        token = generate_token(self.user.username, ['read:metrics'])
+        res = self.client().get('/api/metrics',
+                                headers={'Authorization': 'Bearer %s' % token})
+        json_data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('pool', json_data['data']['db'])
+
+    def test_403_show_metrics(self):
+        res = self.client().get('/api/metrics',
+                                headers={'Authorization': 'Bearer %s' % self.token})
+        self.assertEqual(res.status_code, 403)
+
+    def test_replica_routing(self):
+        # an empty replica, reads served by it find no questions
+        self.app.config['SQLALCHEMY_BINDS'] = {
+            'replica_0': 'sqlite:///' + os.path.join(os.path.dirname(__file__), 'replica.db')}
+        replica = db.get_engine(self.app, bind='replica_0')
+        db.Model.metadata.create_all(replica)
+        try:
+            res = self.client().get('/api/questions')
+            self.assertEqual(len(res.get_json()['data']), 0)
+            # clients read their own writes from primary
+            client = self.client()
+            headers = {'Authorization': 'Bearer %s' % self.token}
+            res = client.post('/api/questions', headers=dict(headers, Origin='https://sal22.tech'),
+                              json={'content': 'Is this great or what'})
+            pin = res.headers['X-Primary-Pin']
+            # cross origin frontends can read the pin
+            self.assertIn('X-Primary-Pin', res.headers['Access-Control-Expose-Headers'])
+            res = client.get('/api/questions', headers=headers)
+            self.assertEqual(len(res.get_json()['data']), 2)
+            # clients without cookies send the pin back in a header
+            res = self.client().get('/api/questions', headers=dict(headers, **{'X-Primary-Pin': pin}))
+            self.assertEqual(len(res.get_json()['data']), 2)
+            # the pin is signed
+            res = self.client().get('/api/questions', headers=dict(headers, **{'X-Primary-Pin': pin + 'x'}))
+            self.assertEqual(len(res.get_json()['data']), 0)
+        finally:
+            db.session.remove()
+            self.app.config['SQLALCHEMY_BINDS'] = None
+            replica.dispose()
+            os.remove(replica.url.database)
+
+    def test_404_show_profile_deleted_user(self):
+        token = generate_token('ghost', [], 0)
+        res = self.client().get('/api/profile',
+                                headers={'Authorization': 'Bearer %s' % token})
+        self.assertEqual(res.status_code, 404)
+
+    def test_export(self):
+        token = generate_token(self.user.username, ['export:data'])
+        res = self.client().get('/api/export/answers',
+                                headers={'Authorization': 'Bearer %s' % token})
+        self.assertEqual(res.status_code, 200)
+        rows = [json.loads(line) for line in res.data.splitlines()]
+        self.assertEqual([row['id'] for row in rows], [self.answer.id])
+        self.assertEqual(rows[0]['content'], self.answer.content)
+
+    def test_403_export(self):
+        res = self.client().get('/api/export/answers',
+                                headers={'Authorization': 'Bearer %s' % self.token})
+        self.assertEqual(res.status_code, 403)
+
     def test_report_question(self):
         res = self.client().post('/api/report/question',
                                  headers={
@@ -375,6 +935,51 @@ class SalTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(json_data['success'])
 
+    def test_send_outbox_digest(self):
+        self.app.config['MAIL_DIGEST'] = True
+        outbox = self.app.extensions['outbox']
+        mail = self.app.extensions['mail']
+        for _ in range(2):
+            self.client().post('/api/report/question',
+                               headers={'Authorization': 'Bearer %s' % self.token},
+                               json={'question_id': self.question.id})
+        with mail.record_messages() as outgoing:
+            self.assertEqual(outbox.send_pending(), 2)
+            self.assertEqual(outbox.send_pending(), 0)
+        self.assertEqual(len(outgoing), 1)
+        self.assertIn('digest', outgoing[0].subject)
+
+    def test_outbox_digest_waits_for_interval(self):
+        self.app.config.update(MAIL_DIGEST=True, MAIL_OUTBOX_WORKER=True)
+        outbox = self.app.extensions['outbox']
+        # a running sender
+        outbox.thread = Thread(target=lambda: None)
+        try:
+            outbox.queue('a@test.com', 'report', 'body', digest=True)
+            self.assertFalse(outbox.wakeup.is_set())
+            outbox.queue('a@test.com', 'reset', 'body')
+            self.assertTrue(outbox.wakeup.is_set())
+        finally:
+            self.app.config['MAIL_OUTBOX_WORKER'] = False
+            outbox.thread = None
+
+    def test_outbox_claims(self):
+        outbox = self.app.extensions['outbox']
+        mail = self.app.extensions['mail']
+        outbox.queue('a@test.com', 'claimed', 'body')
+        # messages claimed by another sender are not sent again
+        self.assertEqual(len(outbox.claim(datetime.utcnow())), 1)
+        # unless it does not report back in time
+        timeout = timedelta(seconds=self.app.config['MAIL_CLAIM_TIMEOUT'])
+        self.assertEqual(len(outbox.claim(datetime.utcnow() + timeout)), 1)
+        outbox.queue('a@test.com', 'subject', 'body')
+        with mail.record_messages() as outgoing:
+            self.assertEqual(outbox.send_pending(), 1)
+        self.assertEqual([msg.subject for msg in outgoing], ['subject'])
+        # sent messages are purged after the retention period
+        self.app.config['MAIL_RETENTION'] = -1
+        self.assertEqual(outbox.purge(), 1)
+
     def test_report_answer(self):
         res = self.client().post('/api/report/answer',
                                  headers={